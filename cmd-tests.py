@@ -16,18 +16,14 @@ class TagmCommandTestCase( unittest.TestCase ):
         self.stdout = sys.stdout = StringIO.StringIO()
         self.stderr = sys.stderr = StringIO.StringIO()
         
-        args.func( self.db, '', args )
+        try:
+            args.func( self.db, '', args )
+        finally:
+            # Also restored when the command exits, its output is then left in self.stdout
+            sys.stdout = self.oldout
+            sys.stderr = self.olderr
         
-        stdout = sys.stdout.getvalue()
-        stderr = sys.stderr.getvalue()
-        
-        sys.stdout.truncate( 0 )
-        sys.stderr.truncate( 0 )
-
-        sys.stdout = self.oldout
-        sys.stderr = self.olderr
-        
-        return stdout, stderr
+        return self.stdout.getvalue(), self.stderr.getvalue()
         
     def tearDown( self ):
         os.chdir( '..' )
@@ -71,7 +67,7 @@ class TestAdd( TagmCommandTestCase ):
         out, err = self.run_command( [ 'add', 'a\\:', 'obj1' ] )
         self.assertEqual( out, 'Added obj1 with tags a\\:\n' )
 
-        curs = self.db.db.execute( 'select * from tags' )
+        curs = self.db.storage.db.execute( 'select * from tags' )
         self.assertEqual( curs.fetchall()[0]['tag'], 'a:' )
 
     def test_add_unicode_obj( self ):
@@ -85,6 +81,61 @@ class TestAdd( TagmCommandTestCase ):
         out, err = self.run_command( [ 'add', tag, 'obj1' ] )
         self.assertEqual( out, u'Added obj1 with tags %s\n' % tag )
 
+class TestIngest( TagmCommandTestCase ):
+    def setUp( self ):
+        super( TestIngest, self ).setUp()
+
+        for i in range( 5 ):
+            os.mknod( 'obj%s' % i )
+
+        self.db.add( [ [ 'b' ] ], [ 'obj3' ] )
+
+    def test_ingest( self ):
+        out, err = self.run_command( [ 'ingest', '--workers', '2', 'a,b:c', 'obj0', 'obj1', 'obj2', 'obj3', 'obj4' ] )
+        self.assertEqual( out, 'Added 5 objects with tags a,b:c\n' )
+
+        self.assertEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj0', 'obj1', 'obj2', 'obj3', 'obj4' ] )
+        self.assertEqual( self.db.get( [ [ 'b' ] ], subtags = True ), [ 'obj3', 'obj0', 'obj1', 'obj2', 'obj4' ] )
+        self.assertEqual( self.db.get_obj_tags( [ 'obj3' ] ), [ [ 'b' ], [ 'a' ], [ 'b', 'c' ] ] )
+        self.assertEqual( [ f for f in os.listdir( '.' ) if f.startswith( '.tagm-ingest-' ) ], [] )
+
+    def test_ingest_glob( self ):
+        out, err = self.run_command( [ 'ingest', '--workers', '1', 'a', 'obj[0-2]', 'obj4' ] )
+        self.assertEqual( out, 'Added 4 objects with tags a\n' )
+
+        self.assertItemsEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj0', 'obj1', 'obj2', 'obj4' ] )
+
+    def test_ingest_glob_split( self ):
+        # A single recursive glob still gets split up between the workers
+        merged = []
+        merge = self.db.merge
+        self.db.merge = lambda shardfile: merged.append( shardfile ) or merge( shardfile )
+
+        out, err = self.run_command( [ 'ingest', '--workers', '2', '-r', 'a', 'obj*' ] )
+        self.assertEqual( out, 'Added 5 objects with tags a\n' )
+
+        self.assertEqual( len( merged ), 2 )
+        self.assertItemsEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj0', 'obj1', 'obj2', 'obj3', 'obj4' ] )
+
+    def test_ingest_invalid_workers( self ):
+        self.assertRaises( ValueError, tagm.ingest, self.db, '', [ [ 'a' ] ], [ 'obj0' ], -1 )
+
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertRaises( SystemExit, self.run_command, [ 'ingest', '--workers', '0', 'a', 'obj0' ] )
+            self.assertIn( 'must be at least 1: 0', sys.stderr.getvalue() )
+        finally:
+            sys.stderr = stderr
+
+    def test_ingest_no_objs( self ):
+        self.assertEqual( tagm.ingest( self.db, '', [ [ 'a' ] ], [] ), [] )
+        self.assertEqual( self.db.get( [ [ 'a' ] ] ), [] )
+        self.assertEqual( [ f for f in os.listdir( '.' ) if f.startswith( '.tagm-ingest-' ) ], [] )
+
+    def test_ingest_not_found( self ):
+        self.assertRaises( IOError, self.run_command, [ 'ingest', '--workers', '2', 'a', 'obj0', 'obj5' ] )
+        self.assertEqual( [ f for f in os.listdir( '.' ) if f.startswith( '.tagm-ingest-' ) ], [] )
+
 class TestAddGlob( TagmCommandTestCase ):
     def setUp( self ):
         super( TestAddGlob, self ).setUp()
@@ -182,6 +233,67 @@ class TestGetObjsByTags( TagmCommandGetTestCase ):
 
 
     
+class TestGetCache( TagmCommandGetTestCase ):
+    def test_get_cache( self ):
+        out, err = self.run_command( [ 'get', '--cache', 'b' ] )
+        self.assertEqual( out, 'obj2\nobj3\n' )
+        self.assertTrue( os.path.exists( '.tagm.cache' ) )
+
+        # A separate process would load the cache from disk
+        self.db.cache = None
+        out, err = self.run_command( [ 'get', '--cache', 'b' ] )
+        self.assertEqual( out, 'obj2\nobj3\n' )
+        self.assertEqual( self.db.cache.hits, 1 )
+
+    def test_get_cache_invalidated( self ):
+        self.run_command( [ 'get', '--cache', 'b' ] )
+        tagm.TagmDB( '.tagm.db' ).add( [ 'b' ], [ 'obj1' ] )
+
+        self.db.cache = None
+        out, err = self.run_command( [ 'get', '--cache', 'b' ] )
+        self.assertEqual( out, 'obj2\nobj3\nobj1\n' )
+        self.assertEqual( self.db.cache.hits, 0 )
+
+    def test_get_cache_recreated_db( self ):
+        self.run_command( [ 'get', '--cache', 'b' ] )
+
+        # A new database with the same number of writes as the old one
+        os.remove( '.tagm.db' )
+        self.db = tagm.TagmDB( '.tagm.db' )
+        for tags in ( [ 'a' ], [ 'b' ], [ 'c' ], [ 'd' ] ):
+            self.db.add( tags, [ 'obj4' ] )
+
+        out, err = self.run_command( [ 'get', '--cache', 'b' ] )
+        self.assertEqual( out, 'obj4\n' )
+        self.assertEqual( self.db.cache.hits, 0 )
+
+    def test_get_cache_hit_not_saved( self ):
+        self.run_command( [ 'get', '--cache', 'b' ] )
+        os.utime( '.tagm.cache', ( 1000, 1000 ) )
+
+        self.db.cache = None
+        self.run_command( [ 'get', '--cache', 'b' ] )
+        self.assertEqual( self.db.cache.hits, 1 )
+        self.assertEqual( os.stat( '.tagm.cache' ).st_mtime, 1000 )
+
+    def test_get_cache_stats( self ):
+        out, err = self.run_command( [ 'get', '--cache', '--cache-stats', 'b' ] )
+        self.assertEqual( out, 'obj2\nobj3\n' )
+        self.assertEqual( err, 'Cache: 0 hits, 1 misses, 1 entries\n' )
+
+        self.db.cache = None
+        out, err = self.run_command( [ 'get', '--cache', '--cache-stats', 'b' ] )
+        self.assertEqual( err, 'Cache: 1 hits, 0 misses, 1 entries\n' )
+
+    def test_get_cache_not_unpickled( self ):
+        # A pickle which would run false when loaded
+        with open( '.tagm.cache', 'wb' ) as f:
+            f.write( 'cos\nsystem\n(S\'false\'\ntR.' )
+
+        out, err = self.run_command( [ 'get', '--cache', '--cache-stats', 'b' ] )
+        self.assertEqual( out, 'obj2\nobj3\n' )
+        self.assertEqual( err, 'Cache: 0 hits, 1 misses, 1 entries\n' )
+
 class TestGetTagsByTags( TagmCommandGetTestCase ):
     def test_get_single_tag( self ):
         out, err = self.run_command( [ 'get', '--tags', 'b' ] )
@@ -235,6 +347,100 @@ class TestGetEscapedColon( TagmCommandTestCase ):
         out, err = self.run_command( [ 'get', '--tags' ] )
         self.assertEqual( out, 'a\\:\n' )
 
+class TestView( TagmCommandGetTestCase ):
+    def test_view( self ):
+        out, err = self.run_command( [ 'view', 'view', 'b', 'c:d' ] )
+        self.assertEqual( out, 'Updated view view, added 3 and removed 0 links\n' )
+
+        self.assertEqual( sorted( os.listdir( 'view/b/%objs' ) ), [ 'obj2', 'obj3' ] )
+        self.assertEqual( os.readlink( 'view/b/%objs/obj2' ), '../../../obj2' )
+        self.assertEqual( os.listdir( 'view/c/d/%objs' ), [ 'obj1' ] )
+        self.assertEqual( os.readlink( 'view/c/d/%objs/obj1' ), '../../../../obj1' )
+
+    def test_view_multiple_tags( self ):
+        self.run_command( [ 'view', 'view', 'a,b' ] )
+        self.assertEqual( sorted( os.listdir( 'view/a/%and/b/%objs' ) ), [ 'obj2', 'obj3' ] )
+
+    def test_view_tagpath_and_tags( self ):
+        self.db.add( [ [ 'a', 'b' ] ], [ 'obj4' ] )
+
+        self.run_command( [ 'view', 'view', 'a:b', 'a,b' ] )
+        self.assertEqual( os.listdir( 'view/a/b/%objs' ), [ 'obj4' ] )
+        self.assertEqual( sorted( os.listdir( 'view/a/%and/b/%objs' ) ), [ 'obj2', 'obj3' ] )
+
+    def test_view_subtags( self ):
+        self.run_command( [ 'view', '--subtags', 'view', 'c' ] )
+        self.assertEqual( sorted( os.listdir( 'view/c/%objs' ) ), [ 'obj1', 'obj3' ] )
+
+    def test_view_update( self ):
+        self.run_command( [ 'view', 'view', 'b', 'c:d' ] )
+
+        self.db.add( [ 'b' ], [ 'obj4' ] )
+        self.db.set( [ 'a' ], [ 'obj1' ] )
+
+        out, err = self.run_command( [ 'view', 'view', 'b', 'c:d' ] )
+        self.assertEqual( out, 'Updated view view, added 1 and removed 1 links\n' )
+
+        self.assertEqual( sorted( os.listdir( 'view/b/%objs' ) ), [ 'obj2', 'obj3', 'obj4' ] )
+        self.assertFalse( os.path.exists( 'view/c' ) )
+
+    def test_view_unchanged( self ):
+        self.run_command( [ 'view', 'view', 'b' ] )
+        out, err = self.run_command( [ 'view', 'view', 'b' ] )
+        self.assertEqual( out, 'Updated view view, added 0 and removed 0 links\n' )
+
+    def test_view_corrupt_snapshot( self ):
+        self.run_command( [ 'view', 'view', 'b', 'c:d' ] )
+
+        with open( 'view/%snapshot', 'wb' ) as f:
+            f.write( 'cos\nsystem\n(S\'false\'\ntR.' )
+
+        # Rebuilt from the links in the view
+        self.db.remove( [ 'obj1' ] )
+        out, err = self.run_command( [ 'view', 'view', 'b', 'c:d' ] )
+        self.assertEqual( out, 'Updated view view, added 0 and removed 1 links\n' )
+        self.assertFalse( os.path.exists( 'view/c' ) )
+
+        out, err = self.run_command( [ 'view', 'view', 'b' ] )
+        self.assertEqual( out, 'Updated view view, added 0 and removed 0 links\n' )
+
+    def test_view_encoded_tags( self ):
+        self.db.add( [ [ '..' ], [ 'AC/DC' ], [ '100%' ] ], [ 'obj4' ] )
+        self.db.add( [ [ 'AC', 'DC' ] ], [ 'obj2' ] )
+
+        self.run_command( [ 'view', 'view', '..', 'AC/DC', 'AC:DC', '100%' ] )
+        self.assertEqual( sorted( os.listdir( 'view' ) ), [ '%2E%2E', '%snapshot', '100%25', 'AC', 'AC%2FDC' ] )
+        self.assertEqual( os.listdir( 'view/%2E%2E/%objs' ), [ 'obj4' ] )
+        self.assertEqual( os.listdir( 'view/AC%2FDC/%objs' ), [ 'obj4' ] )
+        self.assertEqual( os.listdir( 'view/AC/DC/%objs' ), [ 'obj2' ] )
+
+        # Removing the links of .. must not touch anything outside of the view
+        self.db.set( [ 'a' ], [ 'obj4' ] )
+        out, err = self.run_command( [ 'view', 'view', '..' ] )
+        self.assertEqual( out, 'Updated view view, added 0 and removed 4 links\n' )
+        self.assertEqual( sorted( os.listdir( 'view' ) ), [ '%snapshot' ] )
+        self.assertTrue( os.path.exists( 'obj4' ) )
+
+    def test_view_tag_named_as_snapshot( self ):
+        self.db.add( [ [ '.tagm-view' ], [ '%snapshot' ] ], [ 'obj4' ] )
+
+        self.run_command( [ 'view', 'view', '.tagm-view', '%snapshot' ] )
+        self.assertEqual( os.listdir( 'view/.tagm-view/%objs' ), [ 'obj4' ] )
+        self.assertEqual( os.listdir( 'view/%25snapshot/%objs' ), [ 'obj4' ] )
+
+        out, err = self.run_command( [ 'view', 'view', '.tagm-view', '%snapshot' ] )
+        self.assertEqual( out, 'Updated view view, added 0 and removed 0 links\n' )
+
+    def test_view_obj_named_as_tag( self ):
+        os.mknod( '2014' )
+        self.db.add( [ 'a' ], [ '2014' ] )
+        self.db.add( [ [ '2014' ] ], [ 'obj1' ] )
+
+        out, err = self.run_command( [ 'view', 'view', 'a', 'a,2014' ] )
+        self.assertEqual( out, 'Updated view view, added 5 and removed 0 links\n' )
+        self.assertEqual( sorted( os.listdir( 'view/a/%objs' ) ), [ '2014', 'obj1', 'obj2', 'obj3' ] )
+        self.assertEqual( os.listdir( 'view/a/%and/2014/%objs' ), [ 'obj1' ] )
+
 class TestSet( TagmCommandTestCase ):
     def setUp( self ):
         super( TestSet, self ).setUp()
@@ -253,5 +459,91 @@ class TestSet( TagmCommandTestCase ):
 
         self.assertEqual( self.db.get( [ [ 'a' ] ] ), [] )
     
+class TestUntag( TagmCommandGetTestCase ):
+    def test_untag( self ):
+        out, err = self.run_command( [ 'untag', 'a', 'obj1', 'obj2' ] )
+        self.assertEqual( out, (
+            'Removed tags a from obj1\n'
+            'Removed tags a from obj2\n'
+        ) )
+
+        self.assertEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj3' ] )
+
+    def test_untag_tags( self ):
+        out, err = self.run_command( [ 'untag', 'a,b', '--tags', 'c' ] )
+        self.assertEqual( out, 'Removed tags a,b from obj3\n' )
+
+        self.assertEqual( self.db.get_obj_tags( [ 'obj3' ] ), [ [ 'c' ] ] )
+
+    def test_untag_tags_no_match( self ):
+        out, err = self.run_command( [ 'untag', 'a', '--tags', 'e' ] )
+        self.assertEqual( out, '' )
+
+        self.assertEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj1', 'obj2', 'obj3' ] )
+
+    def test_untag_deleted_obj( self ):
+        os.remove( 'obj1' )
+        out, err = self.run_command( [ 'untag', 'c:d', 'obj1' ] )
+        self.assertEqual( out, 'Removed tags c:d from obj1\n' )
+
+        self.assertEqual( self.db.get( [ [ 'c', 'd' ] ] ), [] )
+
+class TestRm( TagmCommandGetTestCase ):
+    def test_rm( self ):
+        out, err = self.run_command( [ 'rm', 'obj3' ] )
+        self.assertEqual( out, 'Removed obj3\n' )
+
+        self.assertEqual( self.db.get( [ [ 'b' ] ] ), [ 'obj2' ] )
+
+    def test_rm_tags( self ):
+        out, err = self.run_command( [ 'rm', '--tags', 'b' ] )
+        self.assertEqual( out, 'Removed obj2\nRemoved obj3\n' )
+
+        self.assertEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj1' ] )
+
+    def test_rm_tags_no_match( self ):
+        out, err = self.run_command( [ 'rm', '--tags', 'e' ] )
+        self.assertEqual( out, '' )
+
+        self.assertEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj1', 'obj2', 'obj3' ] )
+
+    def test_rm_deleted_obj( self ):
+        os.remove( 'obj1' )
+        out, err = self.run_command( [ 'rm', 'obj1' ] )
+        self.assertEqual( out, 'Removed obj1\n' )
+
+        self.assertEqual( self.db.get( [ [ 'a' ] ] ), [ 'obj2', 'obj3' ] )
+
+    def test_rm_vacuum( self ):
+        self.db.add( [ 'e' ], [ 'obj%s' % i for i in range( 10000 ) ] )
+        size = os.path.getsize( '.tagm.db' )
+
+        self.run_command( [ 'rm', '--tags', 'e' ] )
+
+        self.assertLess( os.path.getsize( '.tagm.db' ), size )
+
+class TestChanges( TagmCommandGetTestCase ):
+    def test_changes( self ):
+        out, err = self.run_command( [ 'changes', '--since', '5' ] )
+        self.assertEqual( out, '6 + c obj3\n7 + c:d obj1\n' )
+
+    def test_changes_latest( self ):
+        out, err = self.run_command( [ 'changes' ] )
+        self.assertEqual( out, '' )
+
+    def test_changes_untag( self ):
+        self.run_command( [ 'untag', 'c:d', 'obj1' ] )
+
+        out, err = self.run_command( [ 'changes', '-s', '7' ] )
+        self.assertEqual( out, '8 - c:d obj1\n' )
+
+    def test_changes_compacted( self ):
+        self.db.changes_retention = 2
+        self.db.add( [ 'e' ], [ 'obj4' ] )
+
+        self.assertRaises( SystemExit, self.run_command, [ 'changes', '-s', '5' ] )
+        self.assertEqual( self.stdout.getvalue().splitlines()[0], 'The changes following 5 are no longer kept in the database!' )
+        self.assertIn( 'changes --since 8', self.stdout.getvalue() )
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python2
-import os.path, sys, sqlite3, re
+import os.path, sys, time, sqlite3, re, errno, random, array, struct, collections, copy, marshal
 
 # == Terms ==
 # tag           ie. Sweden
@@ -17,9 +17,111 @@ class TagNotFoundError( Exception ):
 class DBNotFoundError( Exception ):
     pass
 
-class TagmDB( object ):
-    def __init__( self, dbfile = None ):
-        self.dbpath = os.path.split( dbfile )[0]
+class ChangesCompactedError( Exception ):
+    pass
+
+# Change journal ops
+CHANGE_ADD = 1
+CHANGE_REMOVE = 2
+
+def _journal_tagpath( tagpath ):
+    '''
+        Encodes a tagpath as the text kept in the change journal, which does not refer to the
+        tags by id so that they can be removed while the journal still mentions them
+    '''
+    return ':'.join( ( tag.encode( 'UTF-8' ) if isinstance( tag, unicode ) else tag ).replace( '%', '%25' ).replace( ':', '%3A' ) for tag in tagpath )
+
+def _parse_journal_tagpath( text ):
+    return [ tag.replace( '%3A', ':' ).replace( '%25', '%' ) for tag in text.split( ':' ) ]
+
+class QueryCache( object ):
+    '''
+        LRU cache of query results. Entries are tagged with the database's id and write
+        counter and are all dropped as soon as either of them changes.
+
+        If path is given, the cache is kept in that file so that it can be shared
+        between processes, ie. separate runs of the tagm command. The file only holds plain
+        data, so loading it can not run any code.
+
+        The hits and misses counted by stats are those of this instance, they are not kept
+        in the file.
+    '''
+    def __init__( self, size = 128, path = None ):
+        self.size = size
+        self.path = path
+
+        self.version = None
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if path and os.path.exists( path ):
+            self.load()
+
+    def load( self ):
+        try:
+            with open( self.path, 'rb' ) as f:
+                version, entries = marshal.load( f )
+
+            self.entries = collections.OrderedDict( entries )
+            self.version = version
+        except ( IOError, EOFError, ValueError, TypeError ):
+            # Unreadable cache file, just start over with an empty cache
+            pass
+
+    def save( self ):
+        if not self.path:
+            return
+
+        # Write to a temporary file first so that concurrent readers never see a partial cache
+        tmppath = '%s.%s' % ( self.path, os.getpid() )
+        with open( tmppath, 'wb' ) as f:
+            marshal.dump( ( self.version, self.entries.items() ), f, 2 )
+        os.rename( tmppath, self.path )
+
+    def lookup( self, version, key ):
+        '''
+            Returns the cached result for key, or None if there is none for this version of the
+            database, given as a ( database id, write counter ) tuple
+        '''
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+        result = self.entries.pop( key, None )
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # Reinsert to mark as most recently used
+            self.entries[key] = result
+
+        return result
+
+    def store( self, key, result ):
+        self.entries[key] = result
+
+        while len( self.entries ) > self.size:
+            self.entries.popitem( last = False )
+
+    def clear( self ):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats( self ):
+        '''Gets the hits and misses of this instance and the number of entries in the cache'''
+        return { 'hits': self.hits, 'misses': self.misses, 'entries': len( self.entries ) }
+
+class SQLiteStorage( object ):
+    '''
+        Stores the tags in an sqlite3 database, ie. the .tagm.db file.
+
+        Storages are used by TagmDB to look up and store the rows of the objs, tags and
+        objtags tables, all ids are the rowids of those tables.
+    '''
+    def __init__( self, dbfile ):
         self.db = sqlite3.connect( dbfile )
 
         self.db.row_factory = sqlite3.Row
@@ -28,6 +130,9 @@ class TagmDB( object ):
         # Check if the tags table exists
         if not self.db.execute( "select name from sqlite_master WHERE type='table' AND name='tags'" ).fetchone():
             # tags Table does not exist, assume all table are missing, so create them
+            # Free pages are reclaimed by vacuum, in steps, rather than by every commit
+            self.db.execute( 'pragma auto_vacuum = incremental' )
+
             # Objs ( rowid, path )
             self.db.execute( 'create table objs ( path )' )
             self.db.execute( 'create unique index obj_paths on objs (path)' )
@@ -43,6 +148,787 @@ class TagmDB( object ):
             
             self.db.commit()
 
+        # Databases created by older versions lack the meta and changes tables. They are only
+        # added when missing, so that opening a database just to read it never writes to it, which would
+        # fail if the database is read only or locked by another process.
+        self.migrated = self._is_migrated()
+        if not self.migrated:
+            timeout = self.db.execute( 'pragma busy_timeout' ).fetchone()[0]
+            try:
+                # Reading works without it and the first write will try again, so there is no
+                # point in waiting for a lock
+                self.db.execute( 'pragma busy_timeout = 0' )
+                self._migrate()
+            except sqlite3.OperationalError:
+                self.db.rollback()
+            finally:
+                self.db.execute( 'pragma busy_timeout = %d' % timeout )
+
+    def _is_migrated( self ):
+        tables = set( row['name'] for row in self.db.execute( "select name from sqlite_master where type = 'table'" ) )
+        if 'meta' not in tables or 'changes' not in tables:
+            return False
+
+        return self.db.execute( "select count(*) from meta where key in ( 'writes', 'id' )" ).fetchone()[0] == 2
+
+    def _migrate( self ):
+        # Meta ( key, value )
+        self.db.execute( 'create table if not exists meta ( key primary key, value )' )
+        self.db.execute( "insert or ignore into meta ( key, value ) values ( 'writes', 0 )" )
+        # Tells apart databases whose write counters happen to match, ie. a recreated .tagm.db
+        self.db.execute( "insert or ignore into meta ( key, value ) values ( 'id', random() )" )
+
+        # Changes ( seq, op, obj, tagpath ), journal of objtags added and removed
+        self.db.execute( 'create table if not exists changes ( seq integer primary key autoincrement, op, obj, tagpath )' )
+        self.db.commit()
+
+        self.migrated = True
+
+    def _writing( self ):
+        '''Migrates the database, if opening it did not, before anything is written to it'''
+        if not self.migrated:
+            self._migrate()
+
+    def get_tag_id( self, tag, parent ):
+        row = self.db.execute( "select rowid from tags where tag = ? and parent = ?", ( tag, parent ) ).fetchone()
+
+        return row['rowid'] if row else None
+
+    def insert_tag( self, tag, parent ):
+        self._writing()
+
+        return self.db.execute( "insert into tags ( tag, parent ) values ( ?, ? )", ( tag, parent ) ).lastrowid
+
+    def get_tag( self, tag_id ):
+        '''Gets the ( parent, tag ) of the specified tag_id, or None if there is no such tag'''
+        row = self.db.execute( 'select parent, tag from tags where rowid = ?', [tag_id] ).fetchone()
+
+        return ( row['parent'], row['tag'] ) if row else None
+
+    def get_subtag_ids( self, tag_id ):
+        '''Gets the direct subtags of the specified tag_id'''
+        return [ row['rowid'] for row in self.db.execute( 'select rowid from tags where parent = ?', [ tag_id ] ) ]
+
+    def get_obj_id( self, obj ):
+        row = self.db.execute( 'select rowid from objs where path = ?', [obj] ).fetchone()
+
+        return row['rowid'] if row else None
+
+    def get_obj( self, obj_id ):
+        row = self.db.execute( 'select path from objs where rowid = ?', [obj_id] ).fetchone()
+
+        return row['path'] if row else None
+
+    def get_obj_ids( self, objs ):
+        self.db.execute( 'create temp table if not exists lookup_paths ( path primary key )' )
+        self.db.execute( 'delete from lookup_paths' )
+        self.db.executemany( 'insert or ignore into lookup_paths ( path ) values ( ? )', [ ( obj, ) for obj in objs ] )
+
+        query = 'select o.rowid from objs as o join lookup_paths as p on ( o.path = p.path ) order by o.path'
+        
+        return [ row['rowid'] for row in self.db.execute( query ) ]
+
+    def insert_obj( self, obj ):
+        self._writing()
+
+        return self.db.execute( 'insert into objs ( path ) values ( ? )', ( obj, ) ).lastrowid
+
+    def insert_objtags( self, obj_id, tag_ids ):
+        self._writing()
+
+        self.db.executemany( 'insert into objtags ( tag_id, obj_id ) values ( ?, ? )', [ ( tag_id, obj_id ) for tag_id in tag_ids ] )
+
+    def _fill_ids( self, table, ids ):
+        '''Fills the temporary table with ids, for use in set based statements'''
+        self.db.execute( 'create temp table if not exists %s ( id integer primary key )' % table )
+        self.db.execute( 'delete from %s' % table )
+        self.db.executemany( 'insert or ignore into %s ( id ) values ( ? )' % table, [ ( i, ) for i in ids ] )
+
+    def delete_objtags( self, obj_ids, tag_ids = None ):
+        '''
+            Removes the specified tag_ids, or all tags if tag_ids is None, from the obj_ids.
+            Returns the ( obj_id, tag_id ) pairs removed.
+        '''
+        self._writing()
+
+        self._fill_ids( 'delete_objs', obj_ids )
+
+        if tag_ids is None:
+            where = 'obj_id in ( select id from delete_objs )'
+        else:
+            self._fill_ids( 'delete_tags', tag_ids )
+            where = 'obj_id in ( select id from delete_objs ) and tag_id in ( select id from delete_tags )'
+
+        removed = [ tuple( row ) for row in self.db.execute( 'select obj_id, tag_id from objtags where %s order by rowid' % where ) ]
+        self.db.execute( 'delete from objtags where %s' % where )
+
+        return removed
+
+    def log_changes( self, changes ):
+        '''Adds the ( op, obj, tagpath ) changes to the journal, tagpaths encoded by _journal_tagpath'''
+        self._writing()
+
+        self.db.executemany( 'insert into changes ( op, obj, tagpath ) values ( ?, ?, ? )', changes )
+
+    def merge( self, shardfile ):
+        '''Adds the tags of the database in shardfile, which are remapped to the ids of this database'''
+        self._writing()
+
+        # Can not attach in the middle of a transaction
+        self.db.commit()
+        self.db.execute( 'attach database ? as shard', ( shardfile, ) )
+
+        # Maps from the ids in the shard to the ids in this database, created before any
+        # changes are made as creating tables ends the transaction
+        self.db.execute( 'create temp table if not exists tag_map ( shard_id integer primary key, id )' )
+        self.db.execute( 'create temp table if not exists obj_map ( shard_id integer primary key, id )' )
+        self.db.execute( 'create temp table if not exists shard_tagpaths ( shard_id integer primary key, tagpath )' )
+
+        try:
+            self.db.execute( 'delete from tag_map' )
+            self.db.execute( 'delete from obj_map' )
+            self.db.execute( 'delete from shard_tagpaths' )
+
+            # Tags have to be merged one level at a time, as the parent ids of each level
+            # depend on the ids the level above was given
+            self.db.execute( 'insert into tag_map ( shard_id, id ) values ( 0, 0 )' )
+
+            while True:
+                self.db.execute( 'insert or ignore into tags ( tag, parent ) '
+                                 'select s.tag, m.id from shard.tags as s join tag_map as m on ( s.parent = m.shard_id ) '
+                                 'where s.rowid not in ( select shard_id from tag_map ) order by s.rowid' )
+
+                if not self.db.execute( 'insert into tag_map ( shard_id, id ) '
+                                        'select s.rowid, t.rowid from shard.tags as s join tag_map as m on ( s.parent = m.shard_id ) '
+                                        'join tags as t on ( t.tag = s.tag and t.parent = m.id ) '
+                                        'where s.rowid not in ( select shard_id from tag_map )' ).rowcount:
+                    break
+
+            self.db.execute( 'insert or ignore into objs ( path ) select path from shard.objs order by rowid' )
+            self.db.execute( 'insert into obj_map ( shard_id, id ) '
+                             'select s.rowid, o.rowid from shard.objs as s join objs as o on ( o.path = s.path )' )
+
+            self.db.execute( 'insert into objtags ( tag_id, obj_id ) '
+                             'select tm.id, om.id from shard.objtags as s join tag_map as tm on ( s.tag_id = tm.shard_id ) '
+                             'join obj_map as om on ( s.obj_id = om.shard_id ) order by s.rowid' )
+
+            # Parents always have lower ids than their subtags
+            tagpaths = { 0: [] }
+            for row in self.db.execute( 'select rowid, tag, parent from shard.tags order by rowid' ):
+                tagpaths[row['rowid']] = tagpaths[row['parent']] + [ row['tag'] ]
+
+            self.db.executemany( 'insert into shard_tagpaths ( shard_id, tagpath ) values ( ?, ? )',
+                                 [ ( tag_id, _journal_tagpath( tagpath ) ) for tag_id, tagpath in tagpaths.iteritems() if tag_id ] )
+            self.db.execute( 'insert into changes ( op, obj, tagpath ) '
+                             'select ?, o.path, p.tagpath from shard.objtags as s join shard.objs as o on ( s.obj_id = o.rowid ) '
+                             'join shard_tagpaths as p on ( s.tag_id = p.shard_id ) order by s.rowid', ( CHANGE_ADD, ) )
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.commit()
+            self.db.execute( 'detach database shard' )
+
+    def gc( self, limit ):
+        '''
+            Removes up to limit of the objs that have no tags or, once there are none of those
+            left, of the tags that are neither used nor have any subtags, and commits. Returns the
+            number of rows removed, 0 once there is nothing left to remove.
+        '''
+        self._writing()
+
+        removed = self.db.execute( 'delete from objs where rowid in ( '
+                                   'select rowid from objs where rowid not in ( select obj_id from objtags ) limit ? )', ( limit, ) ).rowcount
+
+        if not removed:
+            # Removing a leaftag can leave its parent unused, which the next call will remove
+            removed = self.db.execute( 'delete from tags where rowid in ( '
+                                       'select rowid from tags where rowid not in ( select tag_id from objtags ) '
+                                       'and rowid not in ( select parent from tags ) limit ? )', ( limit, ) ).rowcount
+
+        self.db.commit()
+
+        return removed
+
+    def vacuum( self, pages ):
+        '''Frees up to pages unused pages of the database file, returns the number of pages left to free'''
+        # Databases created before incremental vacuum was enabled can only be vacuumed in full
+        if self.db.execute( 'pragma auto_vacuum' ).fetchone()[0] != 2:
+            return 0
+
+        self.db.commit()
+        self.db.execute( 'pragma incremental_vacuum( %d )' % pages ).fetchall()
+
+        return self.db.execute( 'pragma freelist_count' ).fetchone()[0]
+
+    def _find( self, tagids, obj_tags ):
+        # Start constructing the query
+        where = []
+        query_tags = []
+        query = ''
+        
+        for i, tagid in enumerate( tagids ):
+            if i > 0:
+                query += " left join objtags as t%s on ( t0.obj_id = t%s.obj_id  )" % ( i, i )
+
+            if len( tagid ) > 1:
+                # subtags is True, obj can have any of the listed tags
+                query_tags += tagid
+                where.append( 't%s.tag_id in ( %s )' % ( i, ', '.join( [ '?' ] * len( tagid ) ) ) )
+            else:
+                query_tags.append( tagid[0] )
+                where.append( 't%s.tag_id = ?' % ( i ) )
+
+        # TODO: Rearrange?
+        if not obj_tags:
+            query = "select distinct o.path from objtags as t0" + query
+            query += ' left join objs as o on ( t0.obj_id = o.rowid )'
+        else:
+            query = "select distinct tt.tag_id from objtags as t0" + query
+            query += ' left join objtags as tt on ( tt.obj_id = t0.obj_id and tt.tag_id not in ( %s ) )' % ','.join( [ str( tagid[0] ) for tagid in tagids ] )
+            where.append( 'tt.tag_id not null' )
+
+        if where:
+            query += ' where ' + ' and '.join( where )
+        
+        return [ row[0] for row in self.db.execute( query, query_tags ) ]
+
+    def find_objs( self, tagids ):
+        '''Finds the paths of the objs tagged with any of the tag ids of each of the lists in tagids'''
+        return self._find( tagids, False )
+
+    def find_obj_tags( self, tagids ):
+        '''Finds the further tag ids of the objs that find_objs would find'''
+        return self._find( tagids, True )
+
+    def find_common_tags( self, obj_ids ):
+        '''Finds the tag ids that all of the obj_ids are tagged with'''
+        query = "select distinct o0.tag_id from objtags as o0"
+        where = []
+        
+        for i, obj in enumerate( obj_ids ):
+            if i > 0:
+                query += " left join objtags as o%s on ( o0.tag_id = o%s.tag_id )" % ( i, i )
+            
+            where.append( 'o%s.obj_id = ?' % ( i ) )
+        
+        if where:
+            query += ' where ' + ' and '.join( where )
+        
+        return [ row['tag_id'] for row in self.db.execute( query, obj_ids ) ]
+
+    def get_changes( self, seq, limit ):
+        '''Gets up to limit, or all if limit is negative, ( seq, op, obj, tagpath ) rows of the change journal following seq'''
+        if not self.migrated:
+            return []
+
+        return [ tuple( row ) for row in self.db.execute( 'select seq, op, obj, tagpath from changes where seq > ? order by seq limit ?', ( seq, limit ) ) ]
+
+    def get_first_change( self ):
+        '''Gets the seq of the oldest change in the journal, or of the next change if it is empty'''
+        if not self.migrated:
+            return 1
+
+        row = self.db.execute( 'select min( seq ) from changes' ).fetchone()
+        if row[0] is not None:
+            return row[0]
+
+        row = self.db.execute( "select seq from sqlite_sequence where name = 'changes'" ).fetchone()
+        return row[0] + 1 if row else 1
+
+    def get_last_change( self ):
+        if not self.migrated:
+            return 0
+
+        row = self.db.execute( 'select max( seq ) from changes' ).fetchone()
+
+        return row[0] if row[0] is not None else self.get_first_change() - 1
+
+    def compact_changes( self, keep ):
+        '''Removes all but the keep latest changes from the journal'''
+        self._writing()
+
+        self.db.execute( 'delete from changes where seq <= ( select max( seq ) from changes ) - ?', ( keep, ) )
+
+    def get_id( self ):
+        '''Gets the random id the database was given when it was created, None if it has not been migrated yet'''
+        return self._get_meta( 'id', None )
+
+    def get_writes( self ):
+        '''Gets the write counter, which is bumped by every commit that changes the database'''
+        return self._get_meta( 'writes', 0 )
+
+    def _get_meta( self, key, default ):
+        if not self.migrated:
+            return default
+
+        return self.db.execute( 'select value from meta where key = ?', ( key, ) ).fetchone()[0]
+
+    def commit( self ):
+        self._writing()
+
+        self.db.execute( "update meta set value = value + 1 where key = 'writes'" )
+        self.db.commit()
+
+class ColumnarStorage( object ):
+    '''
+        Keeps the tags in memory in array backed columns, avoiding the overhead of going
+        through sql for read mostly workloads. Ids are the row index in the columns plus one,
+        removed objtags are marked by a tag id of 0 and removed tags and objs by None.
+
+        The columns can be snapshotted to a file with save, and loaded again by passing its
+        path to the constructor, which reads the columns directly into their arrays. The whole
+        snapshot is read, as the columns have to stay appendable. Snapshots use the native
+        layout of array( 'l' ) so they are not portable between platforms.
+    '''
+    SNAPSHOT_MAGIC = 'TAGMCOL4'
+    # magic, itemsize, id, writes, tags, objs, objtags, changes, first change, tag names bytes, obj paths bytes,
+    # change objs bytes, change tagpaths bytes
+    SNAPSHOT_HEADER = struct.Struct( '<8s12q' )
+
+    def __init__( self, path = None ):
+        # Tags ( tag, parent )
+        self.tag_names = []
+        self.tag_parents = array.array( 'l' )
+
+        # Objs ( path )
+        self.obj_paths = []
+
+        # ObjTags ( tag_id, obj_id )
+        self.objtag_tags = array.array( 'l' )
+        self.objtag_objs = array.array( 'l' )
+
+        # Changes ( op, obj, tagpath ), the seq of each change is its index plus first_change
+        self.change_ops = array.array( 'l' )
+        self.change_objs = []
+        self.change_tagpaths = []
+        self.first_change = 1
+
+        self.id = random.getrandbits( 62 )
+        self.writes = 0
+
+        if path:
+            self.load( path )
+
+        self._build_indexes()
+
+    @classmethod
+    def from_sqlite( cls, storage ):
+        '''Creates a ColumnarStorage with a copy of the contents of the specified SQLiteStorage'''
+        self = cls()
+        db = storage.db
+
+        # Rowids can have gaps left by removed rows, so they are renumbered
+        tag_ids = { 0: 0 }
+        for row in db.execute( 'select rowid, tag, parent from tags order by rowid' ):
+            tag_ids[row['rowid']] = len( self.tag_names ) + 1
+            self.tag_names.append( self._intern( row['tag'] ) )
+            self.tag_parents.append( row['parent'] )
+
+        # Parents always have lower ids than their subtags
+        self.tag_parents = array.array( 'l', [ tag_ids[parent] for parent in self.tag_parents ] )
+
+        obj_ids = {}
+        for row in db.execute( 'select rowid, path from objs order by rowid' ):
+            obj_ids[row['rowid']] = len( self.obj_paths ) + 1
+            self.obj_paths.append( self._intern( row['path'] ) )
+
+        for row in db.execute( 'select tag_id, obj_id from objtags order by rowid' ):
+            self.objtag_tags.append( tag_ids[row['tag_id']] )
+            self.objtag_objs.append( obj_ids[row['obj_id']] )
+
+        # Keep the seqs of the journal, so that subscribers can carry on from the same seq
+        self.first_change = storage.get_first_change()
+        self.log_changes( [ change[1:] for change in storage.get_changes( 0, -1 ) ] )
+
+        if storage.get_id() is not None:
+            self.id = storage.get_id()
+        self.writes = storage.get_writes()
+
+        self._build_indexes()
+
+        return self
+
+    def _intern( self, s ):
+        # Store text the way SQLiteStorage returns it, as utf-8 encoded str
+        if isinstance( s, unicode ):
+            s = s.encode( 'UTF-8' )
+
+        return intern( s )
+
+    def _build_indexes( self ):
+        self.tag_index = {}
+        self.tag_children = collections.defaultdict( list )
+        for i, ( tag, parent ) in enumerate( zip( self.tag_names, self.tag_parents ) ):
+            if tag is not None:
+                self.tag_index[( tag, parent )] = i + 1
+                self.tag_children[parent].append( i + 1 )
+
+        self.obj_index = dict( ( path, i + 1 ) for i, path in enumerate( self.obj_paths ) if path is not None )
+
+        self.by_tag = collections.defaultdict( lambda: array.array( 'l' ) )
+        self.by_obj = collections.defaultdict( lambda: array.array( 'l' ) )
+        for row, ( tag_id, obj_id ) in enumerate( zip( self.objtag_tags, self.objtag_objs ) ):
+            if tag_id:
+                self.by_tag[tag_id].append( row )
+                self.by_obj[obj_id].append( row )
+
+    def load( self, path ):
+        with open( path, 'rb' ) as f:
+            header = f.read( self.SNAPSHOT_HEADER.size )
+
+            if len( header ) < self.SNAPSHOT_HEADER.size:
+                raise IOError, 'Not a tagm snapshot: %s' % path
+
+            ( magic, itemsize, self.id, self.writes, ntags, nobjs, nobjtags, nchanges, self.first_change,
+              tag_names_len, obj_paths_len, change_objs_len, change_tagpaths_len ) = self.SNAPSHOT_HEADER.unpack( header )
+
+            if magic != self.SNAPSHOT_MAGIC or itemsize != self.tag_parents.itemsize:
+                raise IOError, 'Not a tagm snapshot for this platform: %s' % path
+
+            def read_column( n ):
+                # Straight from the file into the array, without going through a str
+                column = array.array( 'l' )
+                try:
+                    column.fromfile( f, n )
+                except EOFError:
+                    raise IOError, 'Not a tagm snapshot, cut short: %s' % path
+                return column
+
+            self.tag_parents = read_column( ntags )
+            tag_name_lens = read_column( ntags )
+            obj_path_lens = read_column( nobjs )
+            self.objtag_tags = read_column( nobjtags )
+            self.objtag_objs = read_column( nobjtags )
+            self.change_ops = read_column( nchanges )
+            change_obj_lens = read_column( nchanges )
+            change_tagpath_lens = read_column( nchanges )
+
+            def read_strings( lens, n ):
+                data = f.read( n )
+                if len( data ) < n:
+                    raise IOError, 'Not a tagm snapshot, cut short: %s' % path
+
+                strings = []
+                pos = 0
+                for l in lens:
+                    if l < 0:
+                        # Removed
+                        strings.append( None )
+                    else:
+                        strings.append( intern( data[ pos : pos + l ] ) )
+                        pos += l
+                return strings
+
+            self.tag_names = read_strings( tag_name_lens, tag_names_len )
+            self.obj_paths = read_strings( obj_path_lens, obj_paths_len )
+            self.change_objs = read_strings( change_obj_lens, change_objs_len )
+            self.change_tagpaths = read_strings( change_tagpath_lens, change_tagpaths_len )
+
+    def save( self, path ):
+        '''Saves a snapshot of the columns in the file at path'''
+        # Leave out removed objtags
+        live = [ row for row, tag_id in enumerate( self.objtag_tags ) if tag_id ]
+        objtag_tags = array.array( 'l', [ self.objtag_tags[row] for row in live ] )
+        objtag_objs = array.array( 'l', [ self.objtag_objs[row] for row in live ] )
+
+        tag_names = ''.join( tag for tag in self.tag_names if tag is not None )
+        obj_paths = ''.join( obj for obj in self.obj_paths if obj is not None )
+        change_objs = ''.join( self.change_objs )
+        change_tagpaths = ''.join( self.change_tagpaths )
+
+        tmppath = '%s.%s' % ( path, os.getpid() )
+        with open( tmppath, 'wb' ) as f:
+            f.write( self.SNAPSHOT_HEADER.pack( self.SNAPSHOT_MAGIC, self.tag_parents.itemsize, self.id, self.writes,
+                                                len( self.tag_names ), len( self.obj_paths ), len( live ),
+                                                len( self.change_ops ), self.first_change,
+                                                len( tag_names ), len( obj_paths ), len( change_objs ), len( change_tagpaths ) ) )
+            self.tag_parents.tofile( f )
+            array.array( 'l', [ len( tag ) if tag is not None else -1 for tag in self.tag_names ] ).tofile( f )
+            array.array( 'l', [ len( obj ) if obj is not None else -1 for obj in self.obj_paths ] ).tofile( f )
+            objtag_tags.tofile( f )
+            objtag_objs.tofile( f )
+            self.change_ops.tofile( f )
+            array.array( 'l', [ len( obj ) for obj in self.change_objs ] ).tofile( f )
+            array.array( 'l', [ len( tagpath ) for tagpath in self.change_tagpaths ] ).tofile( f )
+            f.write( tag_names )
+            f.write( obj_paths )
+            f.write( change_objs )
+            f.write( change_tagpaths )
+        os.rename( tmppath, path )
+
+    def get_tag_id( self, tag, parent ):
+        return self.tag_index.get( ( self._intern( tag ), parent ) )
+
+    def insert_tag( self, tag, parent ):
+        tag = self._intern( tag )
+
+        self.tag_names.append( tag )
+        self.tag_parents.append( parent )
+
+        tag_id = len( self.tag_names )
+        self.tag_index[( tag, parent )] = tag_id
+        self.tag_children[parent].append( tag_id )
+
+        return tag_id
+
+    def get_tag( self, tag_id ):
+        if not 0 < tag_id <= len( self.tag_names ) or self.tag_names[tag_id - 1] is None:
+            return None
+
+        return ( self.tag_parents[tag_id - 1], self.tag_names[tag_id - 1] )
+
+    def get_subtag_ids( self, tag_id ):
+        return list( self.tag_children.get( tag_id, [] ) )
+
+    def get_obj_id( self, obj ):
+        return self.obj_index.get( self._intern( obj ) )
+
+    def get_obj( self, obj_id ):
+        if not 0 < obj_id <= len( self.obj_paths ):
+            return None
+
+        return self.obj_paths[obj_id - 1]
+
+    def get_obj_ids( self, objs ):
+        # Same order as the obj_paths index of SQLiteStorage
+        objs = sorted( set( self._intern( obj ) for obj in objs ) )
+
+        return [ self.obj_index[obj] for obj in objs if obj in self.obj_index ]
+
+    def insert_obj( self, obj ):
+        obj = self._intern( obj )
+
+        self.obj_paths.append( obj )
+
+        obj_id = len( self.obj_paths )
+        self.obj_index[obj] = obj_id
+
+        return obj_id
+
+    def insert_objtags( self, obj_id, tag_ids ):
+        for tag_id in tag_ids:
+            row = len( self.objtag_tags )
+
+            self.objtag_tags.append( tag_id )
+            self.objtag_objs.append( obj_id )
+
+            self.by_tag[tag_id].append( row )
+            self.by_obj[obj_id].append( row )
+
+    def log_changes( self, changes ):
+        for op, obj, tagpath in changes:
+            self.change_ops.append( op )
+            self.change_objs.append( self._intern( obj ) )
+            self.change_tagpaths.append( self._intern( tagpath ) )
+
+    def delete_objtags( self, obj_ids, tag_ids = None ):
+        tags = self.objtag_tags
+        removed = []
+
+        if tag_ids is not None:
+            tag_ids = set( tag_ids )
+
+        for obj_id in obj_ids:
+            rows = self.by_obj.pop( obj_id, () )
+            kept = array.array( 'l' )
+
+            for row in rows:
+                if tag_ids is None or tags[row] in tag_ids:
+                    removed.append( ( obj_id, tags[row] ) )
+                    tags[row] = 0
+                else:
+                    kept.append( row )
+
+            if kept:
+                self.by_obj[obj_id] = kept
+
+        return removed
+
+    def merge( self, shardfile ):
+        # Only read from the shard, which going through SQLiteStorage could migrate
+        shard = sqlite3.connect( shardfile )
+        shard.row_factory = sqlite3.Row
+        shard.text_factory = str
+
+        tag_ids = { 0: 0 }
+        tagpaths = { 0: [] }
+        for row in shard.execute( 'select rowid, tag, parent from tags order by rowid' ):
+            parent = tag_ids[row['parent']]
+
+            tag_id = self.get_tag_id( row['tag'], parent )
+            if tag_id is None:
+                tag_id = self.insert_tag( row['tag'], parent )
+
+            tag_ids[row['rowid']] = tag_id
+            tagpaths[row['rowid']] = tagpaths[row['parent']] + [ row['tag'] ]
+
+        obj_ids = {}
+        for row in shard.execute( 'select rowid, path from objs order by rowid' ):
+            obj_id = self.get_obj_id( row['path'] )
+            if obj_id is None:
+                obj_id = self.insert_obj( row['path'] )
+
+            obj_ids[row['rowid']] = obj_id
+
+        changes = []
+        for row in shard.execute( 'select tag_id, obj_id from objtags order by rowid' ):
+            obj_id = obj_ids[row['obj_id']]
+
+            self.insert_objtags( obj_id, [ tag_ids[row['tag_id']] ] )
+            changes.append( ( CHANGE_ADD, self.obj_paths[obj_id - 1], _journal_tagpath( tagpaths[row['tag_id']] ) ) )
+
+        self.log_changes( changes )
+
+        shard.close()
+
+    def gc( self, limit ):
+        # Nothing else can be accessing the columns meanwhile, so everything is removed in one go
+        removed = 0
+
+        for i, obj in enumerate( self.obj_paths ):
+            if obj is not None and not self.by_obj.get( i + 1 ):
+                del self.obj_index[obj]
+                self.obj_paths[i] = None
+                removed += 1
+
+        tags = self.objtag_tags
+        used = set( tag_id for tag_id, rows in self.by_tag.iteritems() if any( tags[row] == tag_id for row in rows ) )
+
+        # Subtags always have higher ids than their parents, so going backwards removes leaftags first
+        for tag_id in xrange( len( self.tag_names ), 0, -1 ):
+            tag, parent = self.tag_names[tag_id - 1], self.tag_parents[tag_id - 1]
+
+            if tag is not None and tag_id not in used and not self.tag_children.get( tag_id ):
+                del self.tag_index[( tag, parent )]
+                self.tag_children[parent].remove( tag_id )
+                self.tag_names[tag_id - 1] = None
+                self.by_tag.pop( tag_id, None )
+                removed += 1
+
+        return removed
+
+    def vacuum( self, pages ):
+        # Drop the removed objtags from the columns, all in one go as nothing else can be
+        # accessing them meanwhile
+        live = [ row for row, tag_id in enumerate( self.objtag_tags ) if tag_id ]
+
+        if len( live ) < len( self.objtag_tags ):
+            self.objtag_tags = array.array( 'l', [ self.objtag_tags[row] for row in live ] )
+            self.objtag_objs = array.array( 'l', [ self.objtag_objs[row] for row in live ] )
+            self._build_indexes()
+
+        return 0
+
+    def _tag_objs( self, tag_ids ):
+        '''Yields the obj ids tagged with any of tag_ids, ordered by tag id and then by row'''
+        tags, objs = self.objtag_tags, self.objtag_objs
+
+        for tag_id in sorted( set( tag_ids ) ):
+            # by_tag is not updated by delete_objtags, so skip the removed rows
+            for row in self.by_tag.get( tag_id, () ):
+                if tags[row] == tag_id:
+                    yield objs[row]
+
+    def _find( self, tagids ):
+        '''Yields the obj ids of the objs tagged with any of the tag ids of each of the lists in tagids'''
+        if not tagids:
+            candidates = ( obj_id for tag_id, obj_id in zip( self.objtag_tags, self.objtag_objs ) if tag_id )
+        else:
+            candidates = self._tag_objs( tagids[0] )
+
+        others = [ set( self._tag_objs( tagid ) ) for tagid in tagids[1:] ]
+
+        for obj_id in candidates:
+            if all( obj_id in objs for objs in others ):
+                yield obj_id
+
+    def find_objs( self, tagids ):
+        paths = []
+        seen = set()
+
+        for obj_id in self._find( tagids ):
+            if obj_id not in seen:
+                seen.add( obj_id )
+                paths.append( self.obj_paths[obj_id - 1] )
+
+        return paths
+
+    def find_obj_tags( self, tagids ):
+        excluded = set( tagid[0] for tagid in tagids )
+        tags = self.objtag_tags
+
+        tag_ids = []
+        seen = set()
+
+        for obj_id in self._find( tagids ):
+            for row in self.by_obj.get( obj_id, () ):
+                tag_id = tags[row]
+                if tag_id not in excluded and tag_id not in seen:
+                    seen.add( tag_id )
+                    tag_ids.append( tag_id )
+
+        return tag_ids
+
+    def find_common_tags( self, obj_ids ):
+        tags = self.objtag_tags
+        obj_tags = [ set( tags[row] for row in self.by_obj.get( obj_id, () ) ) for obj_id in obj_ids[1:] ]
+
+        tag_ids = []
+        seen = set()
+
+        for row in self.by_obj.get( obj_ids[0], () ):
+            tag_id = tags[row]
+            if tag_id not in seen and all( tag_id in other for other in obj_tags ):
+                seen.add( tag_id )
+                tag_ids.append( tag_id )
+
+        return tag_ids
+
+    def get_changes( self, seq, limit ):
+        start = max( seq + 1 - self.first_change, 0 )
+        end = min( start + limit, len( self.change_ops ) ) if limit >= 0 else len( self.change_ops )
+
+        return [ ( self.first_change + i, self.change_ops[i], self.change_objs[i], self.change_tagpaths[i] ) for i in xrange( start, end ) ]
+
+    def get_first_change( self ):
+        return self.first_change
+
+    def get_last_change( self ):
+        return self.first_change + len( self.change_ops ) - 1
+
+    def compact_changes( self, keep ):
+        drop = len( self.change_ops ) - keep
+
+        if drop > 0:
+            del self.change_ops[:drop]
+            del self.change_objs[:drop]
+            del self.change_tagpaths[:drop]
+            self.first_change += drop
+
+    def get_id( self ):
+        return self.id
+
+    def get_writes( self ):
+        return self.writes
+
+    def commit( self ):
+        self.writes += 1
+
+class TagmDB( object ):
+    # Rows removed by each garbage collection step, and seconds to wait between the steps of
+    # garbage collection and vacuum so that other processes get at the database
+    gc_step = 1000
+    step_pause = 0.01
+
+    def __init__( self, dbfile = None, cache = None, storage = None, changes_retention = 100000 ):
+        self.dbpath = os.path.split( dbfile )[0] if dbfile else ''
+        self.storage = storage if storage is not None else SQLiteStorage( dbfile )
+        self.cache = cache
+
+        # Number of changes kept in the change journal
+        self.changes_retention = changes_retention
+
     # Private util methods
     def _get_tag_ids( self, parsed_tagpaths, create = False ):
         '''Takes a list of tagpaths and returns the tag id of the leaf nodes'''
@@ -51,15 +937,15 @@ class TagmDB( object ):
         for tagpath in parsed_tagpaths:
             pid = 0
             for tag in tagpath:
-                row = self.db.execute( "select rowid from tags where tag = ? and parent = ?", ( tag, pid ) ).fetchone()
+                tag_id = self.storage.get_tag_id( tag, pid )
                 
-                if not row:
+                if tag_id is None:
                     if create:
-                        pid = self.db.execute( "insert into tags ( tag, parent ) values ( ?, ? )", ( tag, pid ) ).lastrowid
+                        tag_id = self.storage.insert_tag( tag, pid )
                     else:
                         raise TagNotFoundError
-                else:
-                    pid = row['rowid']
+
+                pid = tag_id
                 
             tag_ids.append( pid )
         return tag_ids
@@ -68,26 +954,27 @@ class TagmDB( object ):
         '''Gets the subtags for the specified tag_id. Will search recursively'''
         subtags = []
                 
-        query = 'select rowid from tags where parent = ?'
-        for tag in self.db.execute( query, [ tag_id ] ):
-            subtags.append( tag['rowid'] )
+        for subtag_id in self.storage.get_subtag_ids( tag_id ):
+            subtags.append( subtag_id )
             
-            subtags += self._get_subtag_ids( tag['rowid'] )
+            subtags += self._get_subtag_ids( subtag_id )
         
         return subtags
 
     def _get_tagpath( self, tag_id ):
         '''Gets the tagpath for the specifed tag_id'''
-        row = self.db.execute( 'select parent, tag from tags where rowid = ?', [tag_id] ).fetchone()
+        row = self.storage.get_tag( tag_id )
         
         tagnames = []
         
         if not row:
             raise TagNotFoundError
 
-        if row['parent']:
-            tagnames += self._get_tagpath( row['parent'] )
-        tagnames.append( row['tag'] )
+        parent, tag = row
+
+        if parent:
+            tagnames += self._get_tagpath( parent )
+        tagnames.append( tag )
         
         return tagnames
     
@@ -95,9 +982,58 @@ class TagmDB( object ):
         # TODO: Should raise exception on nonexisting objects like _get_tag_ids
         #       Will currently cause tags to be returned for objects which dont have
         #       any of the tags presented. Could cause unexpected behavior.
-        query = "select rowid from objs where path in ( '" + "','".join( objs ) + "' )"
-        
-        return [ row['rowid'] for row in self.db.execute( query ) ]
+        return self.storage.get_obj_ids( objs )
+
+    def _get_obj_id( self, obj ):
+        '''Gets the obj id of obj, adding obj if it does not exist yet'''
+        obj_id = self.storage.get_obj_id( obj )
+
+        if obj_id is None:
+            obj_id = self.storage.insert_obj( obj )
+
+        return obj_id
+
+    def _get_journal_tagpaths( self, tag_ids ):
+        return [ _journal_tagpath( self._get_tagpath( tag_id ) ) for tag_id in tag_ids ]
+
+    def _log_removed( self, removed ):
+        '''Adds the removal of the ( obj_id, tag_id ) pairs to the change journal'''
+        objs = {}
+        tagpaths = {}
+
+        changes = []
+        for obj_id, tag_id in removed:
+            if obj_id not in objs:
+                objs[obj_id] = self.storage.get_obj( obj_id )
+            if tag_id not in tagpaths:
+                tagpaths[tag_id] = _journal_tagpath( self._get_tagpath( tag_id ) )
+
+            changes.append( ( CHANGE_REMOVE, objs[obj_id], tagpaths[tag_id] ) )
+
+        self.storage.log_changes( changes )
+
+    def _commit( self ):
+        self.storage.compact_changes( self.changes_retention )
+        self.storage.commit()
+
+    def _cached( self, key, query ):
+        '''Returns the result of calling query, using the query cache if there is one'''
+        if self.cache is None or self.storage.get_id() is None:
+            # Without an id, entries could be mistaken for those of another database
+            return query()
+
+        result = self.cache.lookup( ( self.storage.get_id(), self.storage.get_writes() ), key )
+
+        if result is None:
+            result = query()
+            self.cache.store( key, copy.deepcopy( result ) )
+
+            # Only misses change the entries, so hits do not have to pay for rewriting the cache file
+            self.cache.save()
+        else:
+            result = copy.deepcopy( result )
+
+        return result
     
     # Public methods
     def add( self, tags, objs = None, find = None ):
@@ -105,6 +1041,7 @@ class TagmDB( object ):
             Adds tags to the specified objects
         '''
         tags = self._get_tag_ids( tags, True )
+        tagpaths = self._get_journal_tagpaths( tags )
         
         # If no objs, find can be used to search internaly for objs
         if not objs:
@@ -112,45 +1049,142 @@ class TagmDB( object ):
         elif isinstance( objs, basestring ):
             objs = [ objs ]
         
+        changes = []
         for obj in objs:
-            row = self.db.execute( 'select rowid from objs where path = ?', [obj] ).fetchone()
-            
-            if not row:
-                curs = self.db.execute( 'insert into objs ( path ) values ( ? )', ( obj, ) )
-                obj_id = curs.lastrowid
-            else:
-                obj_id = row['rowid']
-            
-            for i, tag_id in enumerate( tags ):
-                self.db.execute( 'insert into objtags ( tag_id, obj_id ) values ( ?, ? )', ( tag_id, obj_id ) )
+            self.storage.insert_objtags( self._get_obj_id( obj ), tags )
+            changes += [ ( CHANGE_ADD, obj, tagpath ) for tagpath in tagpaths ]
         
-        self.db.commit()
+        self.storage.log_changes( changes )
+        self._commit()
 
     def set( self, tags, objs = None, find = None ):
         tags = self._get_tag_ids( tags, True )
+        tagpaths = self._get_journal_tagpaths( tags )
 
         if not objs:
             objs = self.get( find )
         elif isinstance( objs, basestring ):
             objs = [ objs ]
 
+        # The lists keep the order the objs were given in
+        obj_ids = []
+        paths = []
+        seen = set()
         for obj in objs:
-            row = self.db.execute( 'select rowid from objs where path = ?', [obj] ).fetchone()
-            
-            if not row:
-                curs = self.db.execute( 'insert into objs ( path ) values ( ? )', ( obj, ) )
-                obj_id = curs.lastrowid
-            else:
-                obj_id = row['rowid']
+            obj_id = self._get_obj_id( obj )
+            if obj_id not in seen:
+                seen.add( obj_id )
+                obj_ids.append( obj_id )
+                paths.append( obj )
 
-            # Remove any existing tags
-            self.db.execute( 'delete from objtags where obj_id = ?', ( obj_id, ) )
+        # Remove any existing tags
+        self._log_removed( self.storage.delete_objtags( obj_ids ) )
 
-            # Add the new tags
-            for i, tag_id in enumerate( tags ):
-                self.db.execute( 'insert into objtags ( tag_id, obj_id ) values ( ?, ? )', ( tag_id, obj_id ) )
+        # Add the new tags
+        changes = []
+        for obj_id, obj in zip( obj_ids, paths ):
+            self.storage.insert_objtags( obj_id, tags )
+            changes += [ ( CHANGE_ADD, obj, tagpath ) for tagpath in tagpaths ]
         
-        self.db.commit()
+        self.storage.log_changes( changes )
+        self._commit()
+
+    def untag( self, tags, objs = None, find = None ):
+        '''
+            Removes tags from the specified objects. Objects left without any tags are removed,
+            as are tags no longer used by any object.
+        '''
+        tag_ids = []
+        for tagpath in tags:
+            try:
+                tag_ids += self._get_tag_ids( [ tagpath ] )
+            except TagNotFoundError:
+                # Nothing can be tagged with a tag that does not exist
+                pass
+
+        if objs is None:
+            objs = self.get( find )
+        elif isinstance( objs, basestring ):
+            objs = [ objs ]
+
+        if not objs or not tag_ids:
+            return
+
+        self._log_removed( self.storage.delete_objtags( self._get_obj_ids( objs ), tag_ids ) )
+        self._collect()
+
+    def remove( self, objs = None, find = None ):
+        '''
+            Removes the specified objects and their tags. Tags no longer used by any object
+            are removed as well.
+        '''
+        if objs is None:
+            objs = self.get( find )
+        elif isinstance( objs, basestring ):
+            objs = [ objs ]
+
+        if not objs:
+            return
+
+        self._log_removed( self.storage.delete_objtags( self._get_obj_ids( objs ) ) )
+        self._collect()
+
+    def merge( self, shardfile ):
+        '''
+            Adds all of the tags of the objects in the tagm database in shardfile, as if they had
+            been added to this database with add.
+        '''
+        self.storage.merge( shardfile )
+        self._commit()
+
+    def vacuum( self, step = 100 ):
+        '''
+            Gives the space freed by removals back to the filesystem, step pages at a time so
+            that other processes can get at the database in between steps.
+        '''
+        remaining = self.storage.vacuum( step )
+
+        while remaining:
+            time.sleep( self.step_pause )
+
+            left = self.storage.vacuum( step )
+            if left >= remaining:
+                # No progress, ie. another process keeps the pages in use
+                break
+            remaining = left
+
+    def _collect( self ):
+        self.storage.compact_changes( self.changes_retention )
+        self.storage.commit()
+
+        while self.storage.gc( self.gc_step ):
+            time.sleep( self.step_pause )
+
+        self.vacuum()
+
+    def last_change( self ):
+        '''Gets the seq of the latest change, 0 if nothing has been changed yet'''
+        return self.storage.get_last_change()
+
+    def changes_since( self, seq, batch = 1000 ):
+        '''
+            Yields the changes made after seq as ( seq, op, obj, tagpath ) tuples, where op is
+            CHANGE_ADD or CHANGE_REMOVE. Raises ChangesCompactedError if changes following seq
+            have already been removed from the journal, in which case the caller will have to
+            start over from a full query.
+        '''
+        while True:
+            # Checked before every batch, as the journal may be compacted in between them
+            if seq < self.storage.get_first_change() - 1:
+                raise ChangesCompactedError, 'Changes following %s have been compacted' % seq
+
+            changes = self.storage.get_changes( seq, batch )
+
+            if not changes:
+                break
+
+            for seq, op, obj, tagpath in changes:
+                yield seq, op, obj, _parse_journal_tagpath( tagpath )
 
     def get( self, tags, obj_tags = False, subtags = False ):
         '''
@@ -166,6 +1200,11 @@ class TagmDB( object ):
             c will be returned instead, giving the caller a listing of
             what tags are available to further constrain its queries.
         '''
+        key = ( 'get', tuple( tuple( tagpath ) for tagpath in tags ), bool( obj_tags ), bool( subtags ) )
+
+        return self._cached( key, lambda: self._get( tags, obj_tags, subtags ) )
+
+    def _get( self, tags, obj_tags, subtags ):
         try:
             # Lookup the leaftag ids
             tagids = self._get_tag_ids( tags )
@@ -179,67 +1218,24 @@ class TagmDB( object ):
         except TagNotFoundError:
             # One of the tags provided does not exist, thus no query is needed as nothing will be found.
             return []
-        
-        # Start constructing the query
-        where = []
-        query_tags = []
-        query = ''
-        
-        for i, tagid in enumerate( tagids ):
-            if i > 0:
-                query += " left join objtags as t%s on ( t0.obj_id = t%s.obj_id  )" % ( i, i )
-
-            if len( tagid ) > 1:
-                # subtags is True, obj can have any of the listed tags
-                query_tags += tagid
-                where.append( 't%s.tag_id in ( %s )' % ( i, ', '.join( [ '?' ] * len( tagid ) ) ) )
-            else:
-                query_tags.append( tagid[0] )
-                where.append( 't%s.tag_id = ?' % ( i ) )
-
-        # TODO: Rearrange?
-        if not obj_tags:
-            query = "select distinct o.path from objtags as t0" + query
-            query += ' left join objs as o on ( t0.obj_id = o.rowid )'
-        else:
-            query = "select distinct tt.tag_id from objtags as t0" + query
-            query += ' left join objtags as tt on ( tt.obj_id = t0.obj_id and tt.tag_id not in ( %s ) )' % ','.join( [ str( tagid[0] ) for tagid in tagids ] )
-            where.append( 'tt.tag_id not null' )
-
-        if where:
-            query += ' where ' + ' and '.join( where )
-        
-        curs = self.db.execute( query, query_tags )
 
         if not obj_tags:
-            return [ obj['path'] for obj in curs ]
+            return self.storage.find_objs( tagids )
         else:
-            return [ self._get_tagpath( row[0] ) for row in curs ]
+            return [ self._get_tagpath( tag_id ) for tag_id in self.storage.find_obj_tags( tagids ) ]
             
     def get_obj_tags( self, objs ):
-        query = "select distinct o0.tag_id from objtags as o0"
-        where = []
-        
+        objs = list( objs )
+
+        return self._cached( ( 'get_obj_tags', tuple( objs ) ), lambda: self._get_obj_tags( objs ) )
+
+    def _get_obj_tags( self, objs ):
         objs = self._get_obj_ids( objs )
         
         if not objs:
             return []
         
-        for i, obj in enumerate( objs ):
-            if i > 0:
-                query += " left join objtags as o%s on ( o0.tag_id = o%s.tag_id )" % ( i, i )
-            
-            where.append( 'o%s.obj_id = ?' % ( i ) )
-        
-        if where:
-            query += ' where ' + ' and '.join( where )
-        
-        objtags = []
-        
-        for row in self.db.execute( query, objs ):
-            objtags.append( self._get_tagpath( row['tag_id'] ) )
-        
-        return objtags
+        return [ self._get_tagpath( tag_id ) for tag_id in self.storage.find_common_tags( objs ) ]
 
 
 TAGPATH_SEP = ':'
@@ -251,7 +1247,7 @@ def parse_tagpaths( tagpaths ):
 def join_tagpaths( tagpaths ):
     return [ TAGPATH_SEP.join( [ tag.replace( TAGPATH_SEP, '\\' + TAGPATH_SEP ) for tag in tags ] ) for tags in tagpaths ]
 
-def process_paths( dbpath, paths, recursive = False, follow = True ):
+def process_paths( dbpath, paths, recursive = False, follow = True, must_exist = True ):
     import fnmatch
     
     def list_recursive():
@@ -270,17 +1266,219 @@ def process_paths( dbpath, paths, recursive = False, follow = True ):
                     yield os.path.relpath( os.path.realpath( f ) if follow else f , dbpath )
             
             if not objs_found:
-                raise IOError, 'File not found: %s' % path
+                if must_exist:
+                    raise IOError, 'File not found: %s' % path
+
+                # Might still be in the db, ie. if it has been deleted
+                yield os.path.relpath( path, dbpath )
                     
         else:
             yield os.path.relpath( os.path.realpath( path ) if follow else path, dbpath )
 
+# Snapshot of the links in a view, directory holding the obj links of each query, and directory
+# separating the tagpaths of a query, none of them clash with an encoded tag
+VIEW_SNAPSHOT = '%snapshot'
+VIEW_OBJS = '%objs'
+VIEW_AND = '%and'
+
+def _view_dirname( tag ):
+    '''Encodes a tag as a directory name, so that it can neither contain / nor be . or ..'''
+    name = tag.replace( '%', '%25' ).replace( os.sep, '%2F' )
+
+    if name in ( '', os.curdir, os.pardir ):
+        name = name.replace( '.', '%2E' ) or '%00'
+
+    return name
+
+def _load_view_snapshot( viewpath, snapshot_path ):
+    '''
+        Loads the links of the last build of the view from its snapshot, or if the snapshot can
+        not be read, gathers them from the obj directories of the view instead
+    '''
+    try:
+        with open( snapshot_path, 'rb' ) as f:
+            snapshot = marshal.load( f )
+
+        if isinstance( snapshot, dict ) and all( isinstance( link, basestring ) and isinstance( target, basestring )
+                                                 for link, target in snapshot.iteritems() ):
+            return snapshot
+    except ( IOError, EOFError, ValueError, TypeError ):
+        pass
+
+    snapshot = {}
+
+    for root, dirs, files in os.walk( viewpath ):
+        # Links to directories are listed in dirs, but are not walked into
+        for name in dirs + files:
+            link = os.path.relpath( os.path.join( root, name ), viewpath )
+
+            if VIEW_OBJS in link.split( os.sep )[:-1] and os.path.islink( os.path.join( root, name ) ):
+                snapshot[link] = os.readlink( os.path.join( root, name ) )
+
+    return snapshot
+
+def materialize_view( db, dbpath, viewpath, queries, subtags = False ):
+    '''
+        Materializes the results of the queries, each a list of parsed tagpaths, as a tree of
+        symlinks in viewpath. Each tag segment of the query becomes a subdirectory, with a
+        VIEW_AND directory in between its tagpaths, ie. the objects found by the query a:b,c are
+        linked from viewpath/a/b/%and/c/%objs/. Tags are encoded by _view_dirname.
+
+        The links created are stored in a snapshot in the view directory, so that rebuilding the
+        view only touches the links that have actually changed since the last build. Without a
+        readable snapshot, the links already in the view directory are used instead.
+
+        Returns a tuple of the number of links added and removed.
+    '''
+    viewpath = os.path.normpath( viewpath )
+    snapshot_path = os.path.join( viewpath, VIEW_SNAPSHOT )
+
+    # Compute the links that make up the view, as a mapping from link path, relative to the
+    # view directory, to link target
+    links = {}
+
+    # Link targets are relative, so they only depend on how deep the link is in the view
+    dbroot = os.path.relpath( dbpath or '.', viewpath )
+    target_prefixes = {}
+
+    for tags in queries:
+        # Without the separator the queries a:b and a,b would end up in the same directory
+        parts = []
+        for tagpath in tags:
+            if parts:
+                parts.append( VIEW_AND )
+            parts += [ _view_dirname( tag ) for tag in tagpath ]
+
+        querypath = os.path.join( *parts + [ VIEW_OBJS ] )
+
+        for obj in db.get( tags, subtags = subtags ):
+            name = obj
+            if name.startswith( os.pardir ):
+                # Mirror the obj path in the view, without letting it escape from the query directory
+                name = os.path.join( *[ part != os.pardir and part or '__' for part in os.path.normpath( obj ).split( os.sep ) ] )
+
+            link = os.path.join( querypath, name )
+
+            depth = link.count( os.sep )
+            if depth not in target_prefixes:
+                target_prefixes[depth] = os.path.normpath( os.path.join( *( [ os.pardir ] * depth + [ dbroot ] ) ) )
+
+            links[link] = os.path.join( target_prefixes[depth], obj )
+
+    snapshot = _load_view_snapshot( viewpath, snapshot_path )
+
+    removed = [ link for link, target in snapshot.iteritems() if links.get( link ) != target ]
+    added = [ link for link, target in links.iteritems() if snapshot.get( link ) != target ]
+
+    for link in removed:
+        link = os.path.join( viewpath, link )
+        try:
+            os.remove( link )
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        # Prune directories left empty, but never the view directory itself
+        linkdir = os.path.dirname( link )
+        while linkdir != viewpath and linkdir.startswith( os.path.join( viewpath, '' ) ):
+            try:
+                os.rmdir( linkdir )
+            except OSError:
+                break
+            linkdir = os.path.dirname( linkdir )
+
+    for link in added:
+        target = links[link]
+        link = os.path.join( viewpath, link )
+
+        linkdir = os.path.dirname( link )
+        if not os.path.isdir( linkdir ):
+            os.makedirs( linkdir )
+        elif os.path.islink( link ):
+            # Left behind by a build which did not get to save its snapshot
+            os.remove( link )
+
+        os.symlink( target, link )
+
+    if not os.path.isdir( viewpath ):
+        os.makedirs( viewpath )
+
+    tmppath = '%s.%s' % ( snapshot_path, os.getpid() )
+    with open( tmppath, 'wb' ) as f:
+        # Plain data, which unlike a pickle can not run code when it is loaded
+        marshal.dump( links, f, 2 )
+    os.rename( tmppath, snapshot_path )
+
+    return len( added ), len( removed )
+
+def _ingest_shard( args ):
+    shardfile, tags, objs = args
+
+    TagmDB( shardfile ).add( tags, objs )
+
+def ingest( db, dbpath, tags, paths, workers = None, recursive = False, follow = True ):
+    '''
+        Adds the tags to the objects found at paths like add, but splits the objects up between
+        worker processes. Each of them adds its objects to a separate shard database, which are
+        then merged into db.
+
+        Returns the list of objects added.
+    '''
+    import multiprocessing, tempfile, shutil
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    elif workers < 1:
+        raise ValueError, 'Invalid number of workers: %s' % workers
+
+    # Resolve the paths first, as a single glob or recursive path can stand for any number of
+    # objects, and walking the tree once here saves every worker from walking all of it
+    objs = list( process_paths( dbpath, paths, recursive, follow ) )
+
+    if not objs:
+        return objs
+
+    # Keep the objects in order, so that they are added in the same order as by add
+    chunk_size = -( -len( objs ) // workers )
+    chunks = [ objs[ i : i + chunk_size ] for i in range( 0, len( objs ), chunk_size ) ]
+
+    # Keep the shards on the same filesystem as the database
+    sharddir = tempfile.mkdtemp( prefix = '.tagm-ingest-', dir = dbpath or '.' )
+
+    try:
+        shards = [ ( os.path.join( sharddir, 'shard%s.db' % i ), tags, chunk )
+                   for i, chunk in enumerate( chunks ) ]
+
+        if len( shards ) > 1:
+            pool = multiprocessing.Pool( len( shards ) )
+            try:
+                pool.map( _ingest_shard, shards )
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            map( _ingest_shard, shards )
+
+        for shard in shards:
+            db.merge( shard[0] )
+    finally:
+        shutil.rmtree( sharddir )
+
+    return objs
+
 def setup_parser():
     import argparse, sys
 
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(title='subcommands')
 
+    def positive_int( value ):
+        value = int( value )
+        if value < 1:
+            raise argparse.ArgumentTypeError( 'must be at least 1: %s' % value )
+
+        return value
+
     # Init command: Initializes new tagm db file
     def do_init( db, dbpath, ns ):
         db = TagmDB( '.tagm.db' )
@@ -294,8 +1492,11 @@ def setup_parser():
     def do_add( db, dbpath, ns ):
         tags = parse_tagpaths( ns.tags != '' and ns.tags.split(',') or [] )
 
-        for f in process_paths( dbpath, ns.objs, ns.recursive, ns.follow ):
-            db.add( tags, f )
+        # Added in one go, as committing every obj separately is what makes adding many slow
+        objs = list( process_paths( dbpath, ns.objs, ns.recursive, ns.follow ) )
+        db.add( tags, objs )
+
+        for f in objs:
             print 'Added', f, 'with tags', ns.tags
 
     add_help = 'Will add the specified tags to the specified objects'
@@ -307,6 +1508,23 @@ def setup_parser():
     add_parser.add_argument( 'objs', nargs = '+', help = 'List of objects to be tagged' )
     add_parser.set_defaults( func = do_add )
 
+    # Ingest command: adds tags to objects using several processes
+    def do_ingest( db, dbpath, ns ):
+        tags = parse_tagpaths( ns.tags != '' and ns.tags.split(',') or [] )
+
+        objs = ingest( db, dbpath, tags, ns.objs, ns.workers, ns.recursive, ns.follow )
+        print 'Added %s objects with tags %s' % ( len( objs ), ns.tags )
+
+    ingest_help = 'Will add the specified tags to the specified objects, using several processes to speed up adding large numbers of objects'
+    ingest_parser = subparsers.add_parser( 'ingest', help = ingest_help, description = ingest_help )
+    ingest_parser.add_argument( 'tags', help = 'List of tagpaths separated by comma' )
+    ingest_parser.add_argument( '-w', '--workers', type = positive_int, help = 'number of worker processes, defaults to the number of cpus' )
+    ingest_parser.add_argument( '-r', '--recursive', action = 'store_true', help = 'the list of objects is actually a list of recursive glob paths' )
+    ingest_parser.add_argument( '-f', '--no-follow', dest = 'follow', action = 'store_false',
+                        help = 'do not follow any symlinks')
+    ingest_parser.add_argument( 'objs', nargs = '+', help = 'List of objects to be tagged' )
+    ingest_parser.set_defaults( func = do_ingest )
+
     # Set command: directly sets the tags of objects
     def do_set( db, dbpath, ns ):
         tags = parse_tagpaths( ns.tags != '' and ns.tags.split(',') or [] )
@@ -331,6 +1549,53 @@ def setup_parser():
     set_parser.add_argument( 'objs', nargs = '+', help = 'List of objects to be tagged' )
     set_parser.set_defaults( func = do_set )
 
+    # Untag command: removes tags from objects
+    def do_untag( db, dbpath, ns ):
+        tags = parse_tagpaths( ns.tags != '' and ns.tags.split(',') or [] )
+
+        if ns.objs_is_tags:
+            objs = db.get( parse_tagpaths( ns.objs ) )
+        else:
+            objs = list( process_paths( dbpath, ns.objs, ns.recursive, ns.follow, must_exist = False ) )
+
+        db.untag( tags, objs )
+
+        for f in objs:
+            print 'Removed tags', ns.tags, 'from', f
+
+    untag_help = 'Will remove the specified tags from the specified objects'
+    untag_parser = subparsers.add_parser( 'untag', help = untag_help, description = untag_help )
+    untag_parser.add_argument( 'tags', help = 'List of tagpaths separated by comma' )
+    untag_parser.add_argument( '-r', '--recursive', action = 'store_true', help = 'the list of objects is actually a list of recursive glob paths' )
+    untag_parser.add_argument( '-f', '--no-follow', dest = 'follow', action = 'store_false',
+                        help = 'do not follow any symlinks')
+    untag_parser.add_argument( '-t', '--tags', dest = 'objs_is_tags', action = 'store_true',
+                        help = 'the list of objects is actually a list of tagspaths used to lookup the actual objects to untag' )
+    untag_parser.add_argument( 'objs', nargs = '+', help = 'List of objects to be untagged' )
+    untag_parser.set_defaults( func = do_untag )
+
+    # Rm command: removes objects and their tags
+    def do_rm( db, dbpath, ns ):
+        if ns.objs_is_tags:
+            objs = db.get( parse_tagpaths( ns.objs ) )
+        else:
+            objs = list( process_paths( dbpath, ns.objs, ns.recursive, ns.follow, must_exist = False ) )
+
+        db.remove( objs )
+
+        for f in objs:
+            print 'Removed', f
+
+    rm_help = 'Will remove the specified objects, and all of their tags, from the database'
+    rm_parser = subparsers.add_parser( 'rm', help = rm_help, description = rm_help )
+    rm_parser.add_argument( '-r', '--recursive', action = 'store_true', help = 'the list of objects is actually a list of recursive glob paths' )
+    rm_parser.add_argument( '-f', '--no-follow', dest = 'follow', action = 'store_false',
+                        help = 'do not follow any symlinks')
+    rm_parser.add_argument( '-t', '--tags', dest = 'objs_is_tags', action = 'store_true',
+                        help = 'the list of objects is actually a list of tagspaths used to lookup the actual objects to remove' )
+    rm_parser.add_argument( 'objs', nargs = '+', help = 'List of objects to be removed' )
+    rm_parser.set_defaults( func = do_rm )
+
     # Get command: gets objects tagged with tags
     def do_get( db, dbpath, ns ):
         if not isinstance( ns.tags, list ):
@@ -341,6 +1606,9 @@ def setup_parser():
             tags = ns.tags
         
         tags = sum( [ t.split(',') for t in tags ], [] )
+
+        if ns.cache:
+            db.cache = QueryCache( path = os.path.join( dbpath, '.tagm.cache' ) )
         
         if not ns.obj_tags:
             tags = parse_tagpaths( tags )
@@ -354,6 +1622,10 @@ def setup_parser():
         else:
             for obj in objs:
                 print os.path.relpath( os.path.join( dbpath, obj ) )
+
+        if ns.cache_stats and db.cache is not None:
+            # On stderr, so that the listing can still be piped on
+            print >> sys.stderr, 'Cache: %(hits)s hits, %(misses)s misses, %(entries)s entries' % db.cache.stats()
         
             
     get_help = 'Will list all the objects that are taged with all of the specified tags.'
@@ -366,7 +1638,57 @@ def setup_parser():
                         help = 'include subtags of the specified tags in the query')
     get_parser.add_argument( '--obj-tags', action = 'store_true',
                         help = 'lookup the tags of the specified objects instead of the other way around')
+    get_parser.add_argument( '--cache', action = 'store_true',
+                        help = 'reuse results of previous identical queries, stored in .tagm.cache, if the database has not changed since')
+    get_parser.add_argument( '--cache-stats', action = 'store_true',
+                        help = 'print the hits and misses of the cache to stderr, when used with --cache')
     get_parser.set_defaults( func = do_get )
+
+    # Changes command: lists the changes made to the tags of objects
+    def do_changes( db, dbpath, ns ):
+        seq = ns.since if ns.since is not None else db.last_change()
+
+        while True:
+            try:
+                for seq, op, obj, tagpath in db.changes_since( seq ):
+                    print seq, op == CHANGE_ADD and '+' or '-', join_tagpaths( [ tagpath ] )[0], os.path.relpath( os.path.join( dbpath, obj ) )
+            except ChangesCompactedError:
+                print 'The changes following %s are no longer kept in the database!' % seq
+                print 'Please rescan your queries with %s get, then carry on from the latest change by running:' % sys.argv[0]
+                print '%s changes --since %s' % ( sys.argv[0], db.last_change() )
+                sys.exit(1)
+
+            if not ns.follow:
+                break
+
+            sys.stdout.flush()
+            time.sleep( ns.interval )
+
+    changes_help = 'Will list the tags added to (+) and removed from (-) objects, one change per line preceded by its sequence number'
+    changes_parser = subparsers.add_parser( 'changes', help = changes_help, description = changes_help )
+    changes_parser.add_argument( '-s', '--since', type = int,
+                        help = 'list the changes following this sequence number, defaults to the latest change' )
+    changes_parser.add_argument( '-f', '--follow', action = 'store_true',
+                        help = 'keep listing changes as they are made' )
+    changes_parser.add_argument( '-i', '--interval', type = float, default = 1.0,
+                        help = 'seconds between checking for new changes when following, defaults to 1' )
+    changes_parser.set_defaults( func = do_changes )
+
+    # View command: materializes queries as a tree of symlinks
+    def do_view( db, dbpath, ns ):
+        queries = [ parse_tagpaths( query.split(',') ) for query in ns.queries ]
+
+        added, removed = materialize_view( db, dbpath, ns.dir, queries, ns.subtags )
+        print 'Updated view %s, added %s and removed %s links' % ( ns.dir, added, removed )
+
+    view_help = 'Will create or update a directory of symlinks to the objects tagged with the specified tags, one subdirectory per tag'
+    view_parser = subparsers.add_parser( 'view', help = view_help, description = view_help )
+    view_parser.add_argument( 'dir', help = 'directory to create the view in' )
+    view_parser.add_argument( 'queries', nargs = '+',
+                        help = 'list of queries, each a list of tagpaths separated by comma' )
+    view_parser.add_argument( '--subtags', action = 'store_true',
+                        help = 'include subtags of the specified tags in the queries')
+    view_parser.set_defaults( func = do_view )
     
     return parser
 
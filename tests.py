@@ -1,10 +1,15 @@
 #!/usr/bin/env python2
 import tagm
-import unittest
+import os, tempfile, unittest
 
 class TagmTestCase( unittest.TestCase ):
+    storage_class = None
+
     def setUp( self ):
-        self.db = tagm.TagmDB( ':memory:' )
+        if self.storage_class is None:
+            self.db = tagm.TagmDB( ':memory:' )
+        else:
+            self.db = tagm.TagmDB( storage = self.storage_class() )
 
 class TestAdd( TagmTestCase ):
     def test_add_single_obj( self ):
@@ -101,6 +106,391 @@ class TestSet( TagmTestCase ):
         self.db.add( [ 'a' ], [ 'obj1' ] )
         self.assertIsNone( self.db.set( [ 'b' ], find = [ 'a' ] ) )
         self.assertEqual( self.db.get_obj_tags( [ 'obj1' ] ), [ [ 'b' ] ] )
-    
+
+    def test_set_duplicate_objs( self ):
+        self.db.set( [ 'a' ], [ 'obj2', 'obj1', 'obj2' ] )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj2', 'obj1' ] )
+        self.assertEqual( [ change[2] for change in self.db.changes_since( 0 ) ], [ 'obj2', 'obj1' ] )
+
+class TestUntag( TagmGetTestCase ):
+    def test_untag_obj( self ):
+        self.assertIsNone( self.db.untag( [ 'a' ], [ 'obj2' ] ) )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1', 'obj3' ] )
+        self.assertItemsEqual( self.db.get_obj_tags( [ 'obj2' ] ), [ [ 'b' ] ] )
+
+    def test_untag_multiple( self ):
+        self.db.untag( [ 'a', 'b' ], [ 'obj2', 'obj3' ] )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1' ] )
+        self.assertEqual( self.db.get( [ 'b' ] ), [] )
+
+    def test_untag_find( self ):
+        self.db.untag( [ 'a' ], find = [ 'b' ] )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1' ] )
+
+    def test_untag_no_objs( self ):
+        self.assertIsNone( self.db.untag( [ 'a' ], [] ) )
+        self.assertIsNone( self.db.untag( [ 'a' ], find = [ 'e' ] ) )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1', 'obj2', 'obj3' ] )
+
+    def test_untag_invalid_tag( self ):
+        self.db.untag( [ 'a', 'e' ], [ 'obj1' ] )
+        self.assertItemsEqual( self.db.get_obj_tags( [ 'obj1' ] ), [ [ 'c', 'd' ] ] )
+
+    def test_untag_gc_tags( self ):
+        self.db.untag( [ 'b' ], [ 'obj2', 'obj3' ] )
+        self.assertIsNone( self.db.storage.get_tag_id( 'b', 0 ) )
+
+    def test_untag_gc_subtags( self ):
+        self.db.untag( [ [ 'c', 'd' ] ], [ 'obj1' ] )
+        self.assertIsNone( self.db.storage.get_tag_id( 'd', self.db.storage.get_tag_id( 'c', 0 ) ) )
+        # c is still used by obj3
+        self.assertEqual( self.db.get( [ 'c' ], subtags = True ), [ 'obj3' ] )
+
+        self.db.untag( [ 'c' ], [ 'obj3' ] )
+        self.assertIsNone( self.db.storage.get_tag_id( 'c', 0 ) )
+
+    def test_untag_gc_objs( self ):
+        self.db.untag( [ 'a', [ 'c', 'd' ] ], [ 'obj1' ] )
+        self.assertIsNone( self.db.storage.get_obj_id( 'obj1' ) )
+        self.assertIsNotNone( self.db.storage.get_obj_id( 'obj2' ) )
+
+    def test_untag_gc_steps( self ):
+        # Collected one row at a time, the parent tag still goes once its subtag has
+        self.db.gc_step = 1
+        self.db.step_pause = 0
+
+        self.db.untag( [ 'a', 'b', 'c', [ 'c', 'd' ] ], [ 'obj1', 'obj2', 'obj3' ] )
+        self.assertIsNone( self.db.storage.get_obj_id( 'obj1' ) )
+        self.assertIsNone( self.db.storage.get_obj_id( 'obj3' ) )
+        self.assertIsNone( self.db.storage.get_tag_id( 'b', 0 ) )
+        self.assertIsNone( self.db.storage.get_tag_id( 'c', 0 ) )
+
+class TestRemove( TagmGetTestCase ):
+    def test_remove_obj( self ):
+        self.assertIsNone( self.db.remove( [ 'obj3' ] ) )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1', 'obj2' ] )
+        self.assertEqual( self.db.get_obj_tags( [ 'obj3' ] ), [] )
+        self.assertIsNone( self.db.storage.get_obj_id( 'obj3' ) )
+        # c is no longer used, but it is still the parent of c:d
+        self.assertIsNotNone( self.db.storage.get_tag_id( 'c', 0 ) )
+
+    def test_remove_find( self ):
+        self.db.remove( find = [ 'b' ] )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1' ] )
+        self.assertIsNone( self.db.storage.get_tag_id( 'b', 0 ) )
+
+    def test_remove_readd( self ):
+        self.db.remove( [ 'obj1', 'obj2', 'obj3' ] )
+        self.assertEqual( self.db.get( [], obj_tags = True ), [] )
+
+        self.db.add( [ [ 'c', 'd' ] ], [ 'obj2' ] )
+        self.assertEqual( self.db.get( [ 'c' ], subtags = True ), [ 'obj2' ] )
+        self.assertEqual( self.db.get_obj_tags( [ 'obj2' ] ), [ [ 'c', 'd' ] ] )
+
+    def test_remove_no_objs( self ):
+        self.assertIsNone( self.db.remove( [] ) )
+        self.assertIsNone( self.db.remove( find = [ 'e' ] ) )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1', 'obj2', 'obj3' ] )
+
+    def test_remove_quoted_obj( self ):
+        self.db.add( [ 'a' ], [ "it's" ] )
+        self.db.remove( [ "it's" ] )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1', 'obj2', 'obj3' ] )
+
+    def test_remove_injection( self ):
+        self.db.remove( [ "q') or ('1'='1" ] )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1', 'obj2', 'obj3' ] )
+
+class TestMerge( TagmGetTestCase ):
+    def setUp( self ):
+        super( TestMerge, self ).setUp()
+
+        fd, self.shardfile = tempfile.mkstemp()
+        os.close( fd )
+
+        # Tags and objs get different ids in the shard than in the database
+        shard = tagm.TagmDB( self.shardfile )
+        shard.add( [ [ 'c', 'e' ], 'b' ], [ 'obj4', 'obj1' ] )
+        shard.add( [ [ 'c', 'd' ] ], [ 'obj5' ] )
+
+    def tearDown( self ):
+        os.remove( self.shardfile )
+
+    def test_merge( self ):
+        self.assertIsNone( self.db.merge( self.shardfile ) )
+
+        self.assertEqual( self.db.get( [ 'b' ] ), [ 'obj2', 'obj3', 'obj4', 'obj1' ] )
+        self.assertEqual( self.db.get( [ [ 'c', 'e' ] ] ), [ 'obj4', 'obj1' ] )
+        self.assertEqual( self.db.get( [ [ 'c', 'd' ] ] ), [ 'obj1', 'obj5' ] )
+        self.assertItemsEqual( self.db.get_obj_tags( [ 'obj1' ] ), [ [ 'a' ], [ 'b' ], [ 'c', 'd' ], [ 'c', 'e' ] ] )
+
+    def test_merge_changes( self ):
+        seq = self.db.last_change()
+        self.db.merge( self.shardfile )
+
+        self.assertEqual( [ change[1:] for change in self.db.changes_since( seq ) ], [
+            ( tagm.CHANGE_ADD, 'obj4', [ 'c', 'e' ] ), ( tagm.CHANGE_ADD, 'obj4', [ 'b' ] ),
+            ( tagm.CHANGE_ADD, 'obj1', [ 'c', 'e' ] ), ( tagm.CHANGE_ADD, 'obj1', [ 'b' ] ),
+            ( tagm.CHANGE_ADD, 'obj5', [ 'c', 'd' ] ),
+        ] )
+
+    def test_merge_empty( self ):
+        empty = tempfile.mkstemp()
+        os.close( empty[0] )
+        tagm.TagmDB( empty[1] )
+
+        self.db.merge( empty[1] )
+        os.remove( empty[1] )
+
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj1', 'obj2', 'obj3' ] )
+
+class TestChanges( TagmGetTestCase ):
+    def test_changes_since( self ):
+        self.assertEqual( list( self.db.changes_since( 5 ) ), [
+            ( 6, tagm.CHANGE_ADD, 'obj3', [ 'c' ] ),
+            ( 7, tagm.CHANGE_ADD, 'obj1', [ 'c', 'd' ] ),
+        ] )
+
+    def test_changes_set( self ):
+        seq = self.db.last_change()
+        self.db.set( [ 'b' ], [ 'obj1' ] )
+
+        self.assertEqual( list( self.db.changes_since( seq ) ), [
+            ( seq + 1, tagm.CHANGE_REMOVE, 'obj1', [ 'a' ] ),
+            ( seq + 2, tagm.CHANGE_REMOVE, 'obj1', [ 'c', 'd' ] ),
+            ( seq + 3, tagm.CHANGE_ADD, 'obj1', [ 'b' ] ),
+        ] )
+
+    def test_changes_removed( self ):
+        seq = self.db.last_change()
+        self.db.remove( [ 'obj1' ] )
+
+        # The journal still knows the names of the removed obj and tag
+        self.assertItemsEqual( [ change[1:] for change in self.db.changes_since( seq ) ], [
+            ( tagm.CHANGE_REMOVE, 'obj1', [ 'a' ] ),
+            ( tagm.CHANGE_REMOVE, 'obj1', [ 'c', 'd' ] ),
+        ] )
+        self.assertEqual( self.db.get( [ 'a' ] ), [ 'obj2', 'obj3' ] )
+
+    def test_changes_batches( self ):
+        self.assertEqual( [ change[0] for change in self.db.changes_since( 0, batch = 2 ) ], range( 1, 8 ) )
+
+    def test_changes_none( self ):
+        self.assertEqual( list( self.db.changes_since( self.db.last_change() ) ), [] )
+
+    def test_changes_compacted( self ):
+        self.db.changes_retention = 3
+        self.db.add( [ 'e' ], [ 'obj1' ] )
+
+        self.assertEqual( [ change[0] for change in self.db.changes_since( 5 ) ], [ 6, 7, 8 ] )
+        self.assertRaises( tagm.ChangesCompactedError, list, self.db.changes_since( 4 ) )
+
+    def test_changes_compacted_between_batches( self ):
+        changes = self.db.changes_since( 0, batch = 2 )
+        self.assertEqual( [ next( changes )[0], next( changes )[0] ], [ 1, 2 ] )
+
+        self.db.changes_retention = 3
+        self.db.add( [ 'e' ], [ 'obj1' ] )
+
+        self.assertRaises( tagm.ChangesCompactedError, list, changes )
+
+    def test_changes_gc( self ):
+        # The journal does not keep the removed objs and tags around
+        seq = self.db.last_change()
+        self.db.untag( [ 'b' ], [ 'obj2', 'obj3' ] )
+        self.db.remove( [ 'obj1' ] )
+        self.assertIsNone( self.db.storage.get_tag_id( 'b', 0 ) )
+        self.assertIsNone( self.db.storage.get_tag_id( 'd', self.db.storage.get_tag_id( 'c', 0 ) ) )
+        self.assertIsNone( self.db.storage.get_obj_id( 'obj1' ) )
+
+        self.assertEqual( [ change[2:] for change in self.db.changes_since( seq ) ], [
+            ( 'obj2', [ 'b' ] ), ( 'obj3', [ 'b' ] ), ( 'obj1', [ 'a' ] ), ( 'obj1', [ 'c', 'd' ] ),
+        ] )
+
+    def test_changes_escaped_tags( self ):
+        seq = self.db.last_change()
+        self.db.add( [ [ 'a:b', '%3A' ] ], [ 'obj1' ] )
+
+        self.assertEqual( list( self.db.changes_since( seq ) ), [ ( seq + 1, tagm.CHANGE_ADD, 'obj1', [ 'a:b', '%3A' ] ) ] )
+
+class TestQueryCache( TagmGetTestCase ):
+    def setUp( self ):
+        super( TestQueryCache, self ).setUp()
+
+        self.db.cache = tagm.QueryCache( size = 2 )
+
+    def test_cache_hit( self ):
+        self.assertEqual( self.db.get( [ 'b' ] ), [ 'obj2', 'obj3' ] )
+        self.assertEqual( self.db.get( [ 'b' ] ), [ 'obj2', 'obj3' ] )
+        self.assertEqual( ( self.db.cache.hits, self.db.cache.misses ), ( 1, 1 ) )
+
+    def test_cache_flags( self ):
+        self.db.get( [ 'c' ] )
+        self.assertEqual( self.db.get( [ 'c' ], subtags = True ), [ 'obj3', 'obj1' ] )
+        self.assertEqual( ( self.db.cache.hits, self.db.cache.misses ), ( 0, 2 ) )
+
+    def test_cache_obj_tags( self ):
+        self.db.get_obj_tags( [ 'obj1' ] )
+        self.assertItemsEqual( self.db.get_obj_tags( [ 'obj1' ] ), [ [ 'a' ], [ 'c', 'd' ] ] )
+        self.assertEqual( ( self.db.cache.hits, self.db.cache.misses ), ( 1, 1 ) )
+
+    def test_cache_invalidated_by_add( self ):
+        self.db.get( [ 'b' ] )
+        self.db.add( [ 'b' ], [ 'obj1' ] )
+        self.assertEqual( self.db.get( [ 'b' ] ), [ 'obj2', 'obj3', 'obj1' ] )
+        self.assertEqual( self.db.cache.hits, 0 )
+
+    def test_cache_invalidated_by_set( self ):
+        self.db.get( [ 'b' ] )
+        self.db.set( [ 'a' ], [ 'obj2' ] )
+        self.assertEqual( self.db.get( [ 'b' ] ), [ 'obj3' ] )
+        self.assertEqual( self.db.cache.hits, 0 )
+
+    def test_cache_lru( self ):
+        self.db.get( [ 'a' ] )
+        self.db.get( [ 'b' ] )
+        self.db.get( [ 'a' ] )
+        self.db.get( [ 'c' ] )
+        self.assertEqual( len( self.db.cache.entries ), 2 )
+        self.db.get( [ 'a' ] )
+        self.db.get( [ 'b' ] )
+        self.assertEqual( ( self.db.cache.hits, self.db.cache.misses ), ( 2, 4 ) )
+
+    def test_cache_result_copied( self ):
+        self.db.get( [ 'b' ] ).append( 'obj4' )
+        self.assertEqual( self.db.get( [ 'b' ] ), [ 'obj2', 'obj3' ] )
+
+class TestColumnarStorage( TagmGetTestCase ):
+    storage_class = tagm.ColumnarStorage
+
+    def setUp( self ):
+        super( TestColumnarStorage, self ).setUp()
+
+        fd, self.path = tempfile.mkstemp()
+        os.close( fd )
+
+    def tearDown( self ):
+        os.remove( self.path )
+
+    def test_snapshot( self ):
+        self.db.set( [ 'b' ], [ 'obj1' ] )
+        self.db.storage.save( self.path )
+
+        db = tagm.TagmDB( storage = tagm.ColumnarStorage( self.path ) )
+        self.assertEqual( db.get( [ 'b' ] ), [ 'obj2', 'obj3', 'obj1' ] )
+        self.assertEqual( db.get( [ 'c' ], subtags = True ), [ 'obj3' ] )
+        self.assertItemsEqual( db.get_obj_tags( [ 'obj3' ] ), [ [ 'a' ], [ 'b' ], [ 'c' ] ] )
+        self.assertEqual( db.storage.get_writes(), self.db.storage.get_writes() )
+        self.assertEqual( list( db.changes_since( 0 ) ), list( self.db.changes_since( 0 ) ) )
+
+    def test_snapshot_removed( self ):
+        self.db.remove( [ 'obj1' ] )
+        self.db.storage.save( self.path )
+
+        db = tagm.TagmDB( storage = tagm.ColumnarStorage( self.path ) )
+        self.assertEqual( db.get( [ 'a' ] ), [ 'obj2', 'obj3' ] )
+        self.assertIsNone( db.storage.get_obj_id( 'obj1' ) )
+        self.assertEqual( db.get( [ 'c' ], subtags = True ), [ 'obj3' ] )
+
+    def test_snapshot_invalid( self ):
+        with open( self.path, 'wb' ) as f:
+            f.write( '\0' * tagm.ColumnarStorage.SNAPSHOT_HEADER.size )
+
+        self.assertRaises( IOError, tagm.ColumnarStorage, self.path )
+
+    def test_snapshot_cut_short( self ):
+        self.db.storage.save( self.path )
+        size = os.path.getsize( self.path )
+
+        for length in ( tagm.ColumnarStorage.SNAPSHOT_HEADER.size + 1, size - 1 ):
+            with open( self.path, 'r+b' ) as f:
+                f.truncate( length )
+
+            self.assertRaises( IOError, tagm.ColumnarStorage, self.path )
+
+    def test_merge_shard_untouched( self ):
+        fd, shardfile = tempfile.mkstemp()
+        os.close( fd )
+
+        try:
+            shard = tagm.TagmDB( shardfile )
+            shard.add( [ 'e' ], [ 'obj4' ] )
+            shard.storage.db.execute( 'drop table meta' )
+            shard.storage.db.commit()
+
+            self.db.merge( shardfile )
+            self.assertEqual( self.db.get( [ 'e' ] ), [ 'obj4' ] )
+            self.assertIsNone( shard.storage.db.execute( "select name from sqlite_master where name = 'meta'" ).fetchone() )
+        finally:
+            os.remove( shardfile )
+
+    def test_from_sqlite( self ):
+        sqlite_db = tagm.TagmDB( ':memory:' )
+        sqlite_db.add( [ 'a' ], [ 'obj1', 'obj2' ] )
+        sqlite_db.add( [ [ 'a', 'b' ] ], [ 'obj2' ] )
+
+        db = tagm.TagmDB( storage = tagm.ColumnarStorage.from_sqlite( sqlite_db.storage ) )
+        self.assertEqual( db.get( [ 'a' ], subtags = True ), [ 'obj1', 'obj2' ] )
+        self.assertEqual( db.get( [ [ 'a', 'b' ] ] ), [ 'obj2' ] )
+        self.assertEqual( list( db.changes_since( 1 ) ), list( sqlite_db.changes_since( 1 ) ) )
+
+class TestSQLiteStorage( unittest.TestCase ):
+    def setUp( self ):
+        fd, self.path = tempfile.mkstemp()
+        os.close( fd )
+
+        tagm.TagmDB( self.path ).add( [ 'a' ], [ 'obj1', 'obj2' ] )
+
+        # Another process in the middle of writing to the database
+        self.lock = tagm.sqlite3.connect( self.path )
+
+    def tearDown( self ):
+        self.lock.close()
+        os.remove( self.path )
+
+    def drop_tables( self ):
+        # As created by older versions
+        self.lock.execute( 'drop table meta' )
+        self.lock.execute( 'drop table changes' )
+        self.lock.commit()
+
+    def test_open_locked( self ):
+        self.lock.execute( 'begin immediate' )
+
+        db = tagm.TagmDB( self.path )
+        self.assertEqual( db.get( [ 'a' ] ), [ 'obj1', 'obj2' ] )
+        self.assertIsNotNone( db.storage.get_id() )
+
+    def test_open_old( self ):
+        self.drop_tables()
+
+        db = tagm.TagmDB( self.path )
+        self.assertIsNotNone( db.storage.get_id() )
+        self.assertEqual( db.storage.get_writes(), 0 )
+        self.assertEqual( db.last_change(), 0 )
+
+    def test_open_old_locked( self ):
+        self.drop_tables()
+        self.lock.execute( 'begin immediate' )
+
+        db = tagm.TagmDB( self.path )
+        self.assertEqual( db.get( [ 'a' ] ), [ 'obj1', 'obj2' ] )
+        self.assertIsNone( db.storage.get_id() )
+        self.assertEqual( db.storage.get_writes(), 0 )
+        self.assertEqual( db.last_change(), 0 )
+        self.assertEqual( list( db.changes_since( 0 ) ), [] )
+
+        # Migrated by the first write, once the lock is gone
+        self.lock.rollback()
+        db.add( [ 'b' ], [ 'obj1' ] )
+        self.assertIsNotNone( db.storage.get_id() )
+        self.assertEqual( db.storage.get_writes(), 1 )
+        self.assertEqual( [ change[2] for change in db.changes_since( 0 ) ], [ 'obj1' ] )
+
+# Run all of the above tests against the columnar storage as well
+for name, case in globals().items():
+    if isinstance( case, type ) and issubclass( case, TagmTestCase ) and case.storage_class is None:
+        globals()[ 'Columnar' + name ] = type( 'Columnar' + name, ( case, ), { 'storage_class': tagm.ColumnarStorage } )
+
 if __name__ == '__main__':
     unittest.main()